@@ -5,18 +5,50 @@ Simple script to manage entries in openldap.
 
 Usage: 
     python openldap.py -f input.json -o output.csv
+    python openldap.py --serve /var/spool/openldap
 
 Options:
     -h --help
     -f --file	Input file (required)
     -o --out	Output file (required)
+    -p --pipeline	Number of asynchronous writes kept in flight (optional)
+    -t --transactions	Rows whose writes share one LDAP transaction (optional)
+    -w --workers	Number of parallel workers (optional)
+    --hash-workers	Processes hashing passwords ahead of the writes (optional)
+    -a --adaptive	Adapt load to the server and retry transient errors (optional)
+    -c --coalesce	Run only the net effect of actions per account (optional)
+    --reconcile	Make the directory match the input as a full snapshot (optional)
+    --schedule	Send the actions grouped by OU and in DN order (optional)
+    --emit-ldif	Write creates to an LDIF file for slapadd (optional)
+    --dry-run	Run against an in-memory copy of the directory (optional)
+    --snapshot	LDIF file to load for --dry-run instead of searching (optional)
+    --ops	Write the operations --dry-run would send as JSON lines (optional)
+    --metrics	Write counts and timings as JSON or Prometheus text (optional)
+    --read-your-writes	Read recently written accounts from the provider (optional)
+    -s --serve	Keep running on a spool dir, unix:PATH or - (stdin) (optional)
+    --preflight	Reject bad and conflicting rows before any run (optional)
+    -j --journal	Record outcomes and skip rows already applied (optional)
+    -r --resume	Skip the rows the journal records as done (optional)
+    -q --quiet	Do not print the result of every row (optional)
+    --log-level	Lowest level written to the log, default INFO (optional)
+    --log-format	Write the log as text or JSON lines (optional)
+    --notify	Email users whose account was created or renamed (optional)
+    --id-block	uidNumbers a worker takes from IDCOUNTER at a time (optional)
 
 Environment specific script constants are stored in this 
 config file: openldap_settings.py
+
+New users become posixAccounts when IDCOUNTER names a counter entry,
+with a uidNumber taken from it and the same gidNumber.
+
+Writes go to LDAPSERVER. Searches go to the LDAPREPLICAS in turn when
+any are set, and to LDAPSERVER when none of them answers.
     
 Input:
 
-Input file is expected to be in JSON format (e.g. input.json).
+Input file is expected to be in JSON format (e.g. input.json),
+or newline-delimited JSON with one user action object per line.
+It is read as a stream, so it can be larger than memory.
 with these 16 required data fields:
 {
     "useractions": [
@@ -46,13 +78,51 @@ Output:
 
 Output file (e.g. output.csv) will have these fields:
 
-action, username, result (ERROR/SUCCESS: reason)
+action, username, result (ERROR/SUCCESS/UNCHANGED/SKIPPED: reason), seconds
+
+Dry run:
+
+With --dry-run the users under BASEDN (and the IDCOUNTER entry) are 
+read into memory, with one paged search or from a --snapshot LDIF file 
+such as slapcat writes, and the actions run against that copy. Nothing 
+is written to the server; the output file holds the results the run 
+would have, --ops FILE the writes it would send, one JSON object per 
+line:
+    {"op": "add", "dn": DN, "attrs": {ATTR: [VALUE, ...]}}
+    {"op": "modify", "dn": DN, "mods": [[add|delete|replace, ATTR, 
+        [VALUE, ...]], ...]}
+    {"op": "rename", "dn": DN, "newrdn": RDN}
+    {"op": "delete", "dn": DN}
+
+Service:
+
+With --serve the script keeps running with its settings loaded and its
+connections bound, and takes actions until it gets SIGTERM or SIGINT,
+when it finishes the actions it already accepted:
+    DIR	JSON/NDJSON files moved into DIR, results in FILE.csv, FILE is
+    	renamed to FILE.done
+    unix:PATH	NDJSON over connections to a UNIX socket, results are
+    	sent back as JSON lines
+    -	NDJSON on stdin, results as JSON lines on stdout
+--journal, --coalesce, --reconcile, --preflight and --emit-ldif work on
+a whole batch and cannot be combined with --serve.
+
+Notifications:
+
+With --notify a background thread emails username + MAILDOMAIN for 
+every account created and the new name of every account renamed, from 
+MAILFROM over one SMTP connection to SMTPSERVER:SMTPPORT. A server that
+does not answer within SMTPTIMEOUT seconds is retried a few times, then
+its mail is dropped and logged. To try it locally, run a debugging 
+server and set SMTPSERVER = 'localhost' and SMTPPORT = 1025:
+    python -m smtpd -n -c DebuggingServer localhost:1025
 
 Logging:
 
-Script creates a detailed openldap.log
+Script creates a detailed openldap.log, written by a background thread.
+Use --log-level DEBUG for the per-user lookups.
 
-All errors are also printed to stdout.
+All errors are also printed to stdout, unless running with --quiet.
 
 Author: C. Reitsma
 With help from: A. Ablovatski
@@ -63,6 +133,7 @@ Date: 02/22/2016
 
 from __future__ import print_function
 import time
+import random
 import sys
 import json
 import csv
@@ -70,84 +141,431 @@ import argparse
 import logging
 import ldap
 import ldap.modlist as modlist
+import ldif
 import urllib
 import textwrap
 import smtplib
 import base64
 import hashlib
+import threading
+import Queue
+import collections
+import itertools
+import re
+import functools
+import heapq
+import zlib
+import bisect
+import atexit
+import os
+import signal
+import socket
+import tempfile
+import cPickle
+import multiprocessing
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+from ldap.controls import SimplePagedResultsControl, RequestControl
+from ldap.extop import ExtendedRequest
+
+# Prefetched uid index consulted by findUser(), see buildUidIndex()
+UIDINDEX = None
+
+# Results getUserType() and buildDN() remember, see memoized()
+MEMOSIZE = 100000
+
+# Gives new users posix IDs when IDCOUNTER is set, see IDAllocator
+IDALLOCATOR = None
+
+# Entries ExternalSort keeps in memory before spilling to disk
+SORTRUN = 100000
+
+# Per-row messages are not printed to stdout when set, see echo()
+QUIET = False
+
+# Attributes update() manages, in the order UidIndex keeps them
+USERATTRS = ('givenName', 'cn', 'sn', 'uid', 'mail', 'employeeType', 
+            'employeeNumber', 'o', 'businessCategory', 'uidNumber', 
+            'gidNumber', 'homeDirectory')
 
 def main(argv):
     """This is the main body of the script"""
     
-    # Setup the log file
-    logging.basicConfig(
-        filename='openldap.log',level=logging.DEBUG, 
-        format='%(asctime)s, %(levelname)s: %(message)s', 
-        datefmt='%Y-%m-%d %H:%M:%S')
-
-    # Get LDAP creds and other constants from this settings file
-    config_file = 'openldap_settings.py'
-    
-    if not readConfig(config_file):
-        logging.error("unable to parse the settings file")
-        sys.exit()
+    # Nothing of an earlier run in this process carries over
+    global UIDINDEX, IDALLOCATOR, QUIET, METRICS
+    UIDINDEX = None
+    IDALLOCATOR = None
+    QUIET = False
+    METRICS = Metrics()
     
     # Parse script arguments
     parser = argparse.ArgumentParser()                                               
 
-    parser.add_argument("--file", "-f", type=str, required=True, 
+    parser.add_argument("--file", "-f", type=str, 
                         help="Input JSON file with user actions and params")
-    parser.add_argument("--out", "-o", type=str, required=True, 
+    parser.add_argument("--out", "-o", type=str, 
                         help="Output file with results of ldap user actions")
+    parser.add_argument("--serve", "-s", type=str, metavar="SOURCE", 
+                        help="Keep running and take actions from a spool " \
+                            "directory, unix:PATH socket or - for stdin " \
+                            "instead of --file/--out")
+    parser.add_argument("--queue-size", type=int, default=1000, 
+                        help="Actions waiting to run with --serve " \
+                            "(default: 1000)")
+    parser.add_argument("--pipeline", "-p", type=int, default=0, 
+                        help="Number of asynchronous ldap writes to keep in " \
+                            "flight (default: 0, synchronous writes)")
+    parser.add_argument("--transactions", "-t", type=int, default=0, 
+                        metavar="ROWS", 
+                        help="Group the writes of up to ROWS rows in one " \
+                            "LDAP transaction, instead of --pipeline " \
+                            "(default: 0, no transactions)")
+    parser.add_argument("--hash-workers", type=int, default=0, 
+                        metavar="PROCESSES", 
+                        help="Hash passwords in this many processes ahead " \
+                            "of the writes (default: 0, when creating)")
+    parser.add_argument("--workers", "-w", type=int, default=1, 
+                        help="Number of workers with their own ldap " \
+                            "connection (default: 1)")
+    parser.add_argument("--adaptive", "-a", action="store_true", 
+                        help="Adapt concurrency and rate to the server " \
+                            "latency and retry transient errors")
+    parser.add_argument("--max-rate", type=float, default=0, 
+                        help="Highest number of operations per second " \
+                            "with --adaptive (default: no limit)")
+    parser.add_argument("--target-latency", type=float, default=1.0, 
+                        help="Answers slower than this many seconds count " \
+                            "as congestion with --adaptive (default: 1.0)")
+    parser.add_argument("--read-your-writes", type=float, nargs='?', 
+                        const=10.0, default=0, metavar="SECONDS", 
+                        help="Read an account from the provider instead " \
+                            "of a replica for SECONDS after writing to it " \
+                            "(default when given: 10)")
+    parser.add_argument("--retries", type=int, default=5, 
+                        help="Retries of transient errors with --adaptive " \
+                            "(default: 5)")
+    parser.add_argument("--coalesce", "-c", action="store_true", 
+                        help="Collapse several actions on one account into " \
+                            "their net effect (reads the whole batch first)")
+    parser.add_argument("--schedule", type=int, nargs='?', const=100000, 
+                        default=0, metavar="ROWS", 
+                        help="Reorder up to ROWS actions at a time by OU " \
+                            "and DN, keeping the order of actions on one " \
+                            "account (default when given: 100000)")
+    parser.add_argument("--reconcile", action="store_true", 
+                        help="Treat the input as the full list of users " \
+                            "and create, update, rename and delete to " \
+                            "make the directory match it")
+    parser.add_argument("--preflight", action="store_true", 
+                        help="Check the whole input before anything runs " \
+                            "and reject bad or conflicting rows")
+    parser.add_argument("--journal", "-j", type=str, metavar="FILE", 
+                        help="Record the outcome of every row in FILE and " \
+                            "skip rows an earlier run already applied")
+    parser.add_argument("--resume", "-r", action="store_true", 
+                        help="Skip the rows of this input the journal " \
+                            "records as done")
+    parser.add_argument("--notify", action="store_true", 
+                        help="Email users whose account was created or " \
+                            "renamed, over SMTPSERVER")
+    parser.add_argument("--id-block", type=int, default=100, 
+                        help="uidNumbers a worker takes from the IDCOUNTER " \
+                            "entry at a time (default: 100)")
+    parser.add_argument("--log-level", default='INFO', 
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 
+                                    'CRITICAL'], 
+                        help="Lowest level written to openldap.log " \
+                            "(default: INFO)")
+    parser.add_argument("--log-format", choices=['text', 'json'], 
+                        default='text', 
+                        help="Write the log as text or as JSON lines " \
+                            "(default: text)")
+    parser.add_argument("--quiet", "-q", action="store_true", 
+                        help="Do not print the result of every row")
+    parser.add_argument("--metrics", type=str, metavar="FILE", 
+                        help="Write counts and timings of the run to FILE")
+    parser.add_argument("--metrics-format", choices=['json', 'prometheus'], 
+                        default='json', 
+                        help="Format of the metrics file (default: json)")
+    parser.add_argument("--emit-ldif", type=str, metavar="LDIF", 
+                        help="Write the creates to this LDIF file for an " \
+                            "offline slapadd load instead of adding them")
+    parser.add_argument("--dry-run", action="store_true", 
+                        help="Run the actions against an in-memory copy " \
+                            "of the directory and write nothing to it")
+    parser.add_argument("--snapshot", type=str, metavar="LDIF", 
+                        help="Load the copy for --dry-run from this LDIF " \
+                            "file instead of searching the server")
+    parser.add_argument("--ops", type=str, metavar="FILE", 
+                        help="Write the operations --dry-run would send " \
+                            "to FILE as JSON lines")
+    parser.add_argument("--prefetch", action="store_true", 
+                        help="Load all uids with one paged search instead " \
+                            "of searching for every user")
+    parser.add_argument("--prefetch-attrs", action="store_true", 
+                        help="Also keep the attributes update() compares " \
+                            "in the prefetched index")
+    parser.add_argument("--page-size", type=int, default=1000, 
+                        help="Page size of the prefetch search " \
+                            "(default: 1000)")
 
     try:
         args = parser.parse_args()
+        if not args.serve and not (args.file and args.out):
+            parser.error("arguments --file/-f and --out/-o are required")
         
     except SystemExit:
+        setupLogging()
         logging.error("required arguments missing - " \
                         "provide input and output file names")
         sys.exit()
 
+    # Start the hashing processes before any thread, so they do not 
+    # inherit a lock some thread holds
+    hashpool = None
+    if args.hash_workers > 0:
+        hashpool = multiprocessing.Pool(args.hash_workers, ignoreInterrupts)
+
+    # Setup the log file, written by a background thread
+    setupLogging(args.log_level, args.log_format)
+    
+    # Results go to stdout when serving it
+    QUIET = args.quiet or args.serve == '-'
+    
+    if args.resume and not args.journal:
+        print("ERROR: --resume needs a --journal to resume from")
+        logging.error("--resume given without --journal")
+        sys.exit()
+    
+    if (args.snapshot or args.ops) and not args.dry_run:
+        print("ERROR: --snapshot and --ops only apply to a --dry-run")
+        logging.error("--snapshot or --ops given without --dry-run")
+        sys.exit()
+    
+    # A dry run creates and renames nobody, there is nothing to tell
+    if args.notify and args.dry_run:
+        print("ERROR: --notify cannot be used with --dry-run")
+        logging.error("--notify given with --dry-run")
+        sys.exit()
+
+    # These need the whole batch up front, which a service never has
+    if args.serve:
+        batchonly = [name for name, given in [
+                        ("--journal", args.journal),
+                        ("--coalesce", args.coalesce),
+                        ("--reconcile", args.reconcile),
+                        ("--preflight", args.preflight),
+                        ("--emit-ldif", args.emit_ldif)] if given]
+        if batchonly:
+            print("ERROR: {0} cannot be used with --serve" \
+                    .format(", ".join(batchonly)))
+            logging.error("{0} given with --serve" \
+                            .format(", ".join(batchonly)))
+            sys.exit()
+
+    # Reconcile runs rows derived from the input and the directory, which
+    # the journal and the pre-flight know nothing of, and runs them live.
+    # A repeated reconcile only sends what still differs, so it needs no 
+    # journal to resume
+    if args.reconcile:
+        conflicting = [name for name, given in [
+                        ("--journal", args.journal),
+                        ("--preflight", args.preflight),
+                        ("--coalesce", args.coalesce),
+                        ("--emit-ldif", args.emit_ldif)] if given]
+        if conflicting:
+            print("ERROR: {0} cannot be used with --reconcile" \
+                    .format(", ".join(conflicting)))
+            logging.error("{0} given with --reconcile" \
+                            .format(", ".join(conflicting)))
+            sys.exit()
+
+    # Get LDAP creds and other constants from this settings file
+    config_file = 'openldap_settings.py'
+    
+    if not readConfig(config_file):
+        logging.error("unable to parse the settings file")
+        sys.exit()
+
     # Read input from json file
     in_file = args.file
     # Write output to csv file
     out_file = args.out
     
+    # Keep the load within what the server sustains
+    controller = None
+    if args.adaptive:
+        controller = RateController(
+            max(1, args.workers) * max(1, args.pipeline), args.max_rate, 
+            args.target_latency, args.retries)
+
+    # Spread searches over the read replicas
+    replicas = None
+    if LDAPREPLICAS:
+        replicas = ReplicaSet(LDAPREPLICAS, args.read_your_writes)
+
+    # New users get uidNumbers from blocks of the counter entry
+    if IDCOUNTER:
+        IDALLOCATOR = IDAllocator(IDCOUNTER, max(1, args.id_block))
+
+    # One bound LDAP session per worker is shared by all their actions
+    pool = LDAPPool(max(1, args.workers), controller, replicas)
+    
+    # Run against a copy of the directory, which the actions keep up to 
+    # date in UIDINDEX as they do with --prefetch
+    model = None
+    if args.dry_run:
+        if args.snapshot:
+            model = readModel(args.snapshot)
+        else:
+            with pool.session() as l:
+                if l.connect():
+                    model = loadModel(l, args.page_size)
+            pool.close()
+        if model is None:
+            print("ERROR: unable to load the directory for the dry run")
+            logging.error("dry run without a copy of the directory")
+            sys.exit()
+        if args.ops:
+            model.f_ops = open(args.ops, 'wb')
+            logging.info("opened file: {0}".format(args.ops))
+        UIDINDEX = model.index
+        pool = LDAPPool(max(1, args.workers), 
+                        factory=lambda: DryRunSession(model))
+    
+    # Mail goes out from a thread of its own, the writes never wait on it
+    notifier = None
+    if args.notify:
+        if not SMTPSERVER:
+            print("ERROR: --notify needs SMTPSERVER in the settings file")
+            logging.error("--notify given without SMTPSERVER")
+            sys.exit()
+        notifier = Notifier(SMTPSERVER, SMTPPORT, MAILFROM, SMTPTIMEOUT)
+
+    # Run the actions one at a time, keep several writes in flight or group
+    # them in transactions
+    if args.dry_run:
+        # Nothing goes over the wire, so there is nothing to overlap
+        runner = runSequential
+    elif args.transactions > 0:
+        runner = functools.partial(runTransactions, size=args.transactions)
+    elif args.pipeline > 0:
+        runner = functools.partial(runPipelined, window=args.pipeline)
+    else:
+        runner = runSequential
+    
+    # Hash passwords in the pool ahead of the rows that need them
+    if hashpool:
+        stage = lambda rows: hashPasswords(rows, hashpool, 
+                                            args.hash_workers * 16)
+    else:
+        stage = lambda rows: rows
+    
+    # Spread accounts over several workers or use a single session
+    if args.workers > 1:
+        run = lambda rows: runWorkers(pool, stage(rows), args.workers, runner)
+    else:
+        run = lambda rows: runPooled(pool, stage(rows), runner)
+    
+    # Send independent actions grouped by subtree and in DN order
+    if args.schedule > 0:
+        unscheduled = run
+        run = lambda rows: runScheduled(rows, unscheduled, args.schedule)
+    
+    if notifier:
+        unnotified = run
+        run = lambda rows: runNotified(rows, unnotified, notifier)
+    
+    if args.serve:
+        if args.prefetch:
+            logging.warning("--prefetch is ignored with --serve, the " \
+                            "index would go stale")
+        started = time.time()
+        try:
+            serve(args.serve, run, args.queue_size)
+        finally:
+            if notifier:
+                notifier.close()
+            if model:
+                model.close()
+            if args.metrics:
+                writeMetrics(args.metrics, args.metrics_format, 
+                                time.time() - started)
+            pool.close()
+            if hashpool:
+                hashpool.terminate()
+        return
+
+    # Replace per-row existence searches with one streamed scan
+    if args.prefetch and not args.dry_run:
+        with pool.session() as l:
+            if l.connect():
+                UIDINDEX = buildUidIndex(l, args.page_size, 
+                                            args.prefetch_attrs)
+
+    f_ldif = None
+    journal = None
+    started = time.time()
+
     try:
         f_in = open(in_file, 'rb')
         logging.info("opened file: {0}".format(in_file))
         f_out = open(out_file, 'wb')
         logging.info("opened file: {0}".format(out_file))
-        reader = json.load(f_in)
         writer = csv.writer(f_out)
-        writer.writerow( ['action','username','result'] )
+        writer.writerow( ['action','username','result','seconds'] )
         
-        for row in reader["useractions"]:
-            result = ''
-            # Select what needs to be done
-            if row["action"] == 'create':
-                result = create(str(row["username"]), 
-                                str(row["givenName"]), str(row["fullName"]), 
-                                str(row["sn"]), str(row["employeeType"]), 
-                                str(row["DNumber"]), 
-                                str(row["primO"]), str(row["businessCategory"]), 
-                                str(row["userPassword"]))
-            elif row["action"] == 'update':
-                result = update(str(row["username"]), str(row["newusername"]), 
-                                str(row["uidNumber"]), 
-                                str(row["gidNumber"]), str(row["givenName"]), 
-                                str(row["fullName"]), str(row["sn"]), 
-                                str(row["employeeType"]), str(row["DNumber"]), 
-                                str(row["primO"]), str(row["businessCategory"]))
-            elif row["action"] == 'delete':
-                 result = delete(str(row["username"]))
+        # Stream the actions, the input is never loaded as a whole
+        rows = enumerate(readActions(f_in))
+        
+        if args.emit_ldif:
+            f_ldif = open(args.emit_ldif, 'wb')
+            logging.info("opened file: {0}".format(args.emit_ldif))
+            mode = lambda rows: runPooled(pool, stage(rows), 
+                                functools.partial(runLDIF, f_ldif=f_ldif))
+        elif args.reconcile:
+            # Read the directory before anything in it changes
+            if model:
+                present = sortEntries(model.entries())
             else:
-                print("ERROR: unrecognized action")                
-                logging.error("unrecognized action")
-                result = "ERROR: Unrecognized action"
-            
-            # Write the result to the output csv file
-            writer.writerow( [row["action"], row["username"], result] )
+                present = sortEntries(directoryEntries(pool, 
+                                                        args.page_size))
+            mode = lambda rows: run(enumerate(reconcileRows(
+                                    (row for index, row in rows), present)))
+        elif args.coalesce:
+            mode = lambda rows: runCoalesced(rows, run)
+        else:
+            mode = run
+        
+        # Check the whole batch first, bad rows are rejected unrun
+        reject = None
+        if args.preflight:
+            rejected = preflight(enumerate(readActions(f_in)))
+            f_in.seek(0)
+            if rejected:
+                echo("ERROR: pre-flight rejected {0} row(s)" \
+                        .format(len(rejected)))
+            reject = lambda index, row: rejected.get(index)
+        
+        # Leave out the rows that are already applied. Both filters look 
+        # at the input rows in one pass, the journal keys on their index
+        if args.journal:
+            journal = Journal(args.journal)
+            logging.info("opened journal: {0}".format(args.journal))
+            results = runJournaled(rows, mode, journal, args.resume, reject)
+        elif reject:
+            results = runFiltered(rows, mode, reject)
+        else:
+            results = mode(rows)
+        
+        for index, row, result, seconds in results:
+            # Write the result to the output csv file, rows pre-flight 
+            # rejected may lack either field
+            writer.writerow( [row.get("action", ""), row.get("username", ""), 
+                                result, "{0:.6f}".format(seconds)] )
+            # Keep a usable partial output if the run dies
+            f_out.flush()
+            countResult(row, result, seconds)
             
     except IOError:
         print("ERROR: Unable to open input/output file!")
@@ -164,286 +582,1765 @@ def main(argv):
         logging.info("closed file: {0}".format(in_file))
         f_out.close()
         logging.info("closed file: {0}".format(out_file))
+        if f_ldif:
+            f_ldif.close()
+            logging.info("closed file: {0}".format(args.emit_ldif))
+        if journal:
+            journal.close()
+            logging.info("closed journal: {0}".format(args.journal))
+        if notifier:
+            notifier.close()
+        if model:
+            model.close()
+        if args.metrics:
+            writeMetrics(args.metrics, args.metrics_format, 
+                            time.time() - started)
+        pool.close()
+        if hashpool:
+            hashpool.terminate()
         
     return
 
-def create(username, givenName, fullName, sn, employeeType, dNumber, ou, 
-            businessCategory, userPassword):
-    """This function adds users to openldap"""
+def readActions(f, chunksize=65536):
+    """Generator with the useractions entries of an input file
     
-    # Check if any of the parameters are missing
-    params = locals()
+    Reads a {"useractions": [...]} document incrementally, one entry at
+    a time, or newline-delimited JSON with one action per line. Other 
+    keys of the document may come before useractions."""
     
-    for _item in params:
-        if str(params[_item]) == "":
-            print("ERROR: unable to create user {0} because {1} is missing " \
-                    "a value".format(username, _item))
-            logging.error("unable to create user {0} because {1} is missing " \
-                            "a value".format(username, _item))
-            result = "ERROR: Missing an expected input value for " + _item \
-                        + " in input file"
-            return result
-
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
+    decoder = json.JSONDecoder()
+    buf = f.read(max(chunksize, 4096))
     
-    # Catch LDAP connection failure
-    if not l:
-        result = "ERROR: unable to connect to LDAP server"
-        return result
+    # Walk the keys of the top-level object up to useractions. The head 
+    # is kept whole: a first object without useractions is the first 
+    # line of newline-delimited JSON
+    start = re.match(r'\s*\{', buf)
+    pos = start.end() if start else None
+    mark = pos
+    
+    while pos is not None:
+        try:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == '}':
+                pos = None
+                break
+            
+            mark = pos
+            if pos == len(buf):
+                raise ValueError("need more input")
+            key, pos = decoder.raw_decode(buf, pos)
+            
+            # Start of the value of the key
+            pos = re.compile(r'\s*:?\s*').match(buf, pos).end()
+            if pos == len(buf):
+                raise ValueError("need more input")
+            
+            if key == "useractions":
+                if buf[pos] != '[':
+                    raise TypeError("useractions in input file is not a list")
+                pos += 1
+                break
+            
+            # Skip the values of other keys, a number may go on
+            value, pos = decoder.raw_decode(buf, pos)
+            if pos == len(buf):
+                raise ValueError("need more input")
         
-    # Do a quick check if the user already exists
-    if findUser(l, username):
-        print("ERROR: cannot create user - user already exists: {0}" \
-                .format(username))
-        logging.error("cannot create user - user already exists: {0}" \
-                .format(username))
-        result = "ERROR: username already taken!"
-        return result
+        except ValueError:
+            # Key or value continues in the next chunk
+            chunk = f.read(chunksize)
+            if not chunk:
+                raise ValueError("truncated object in input file")
+            buf += chunk
+            pos = mark
+    
+    # Newline-delimited JSON, one action per line
+    if pos is None:
+        lines = itertools.chain(buf.splitlines(True), f) if buf else f
+        pending = ''
+        for line in lines:
+            # The first chunk may end in the middle of a line
+            if not line.endswith('\n'):
+                pending += line
+                continue
+            line, pending = pending + line, ''
+            if line.strip():
+                yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)
+        return
+    
+    # Walk the useractions array, decoding one entry at a time
+    while True:
+        # Skip whitespace and the separators between entries
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
         
-    # Create new user if it does not exist
-    try:
+        if pos < len(buf) and buf[pos] == ']':
+            return
         
-        # Build a dict for the "body" of the user object
-        attrs = {}
-        attrs['objectclass'] = ['top','person','organizationalPerson',
-                                'inetOrgPerson','duPerson', 'qmailUser']
-        attrs['uid'] = username
-        h = hashlib.sha1()
-        h.update(userPassword)
-        attrs['userPassword'] =  '{SHA}' + base64.b64encode(h.digest())
-        attrs['givenName'] = givenName
-        attrs['cn'] = fullName
-        attrs['sn'] = sn
-        attrs['mail'] = username + MAILDOMAIN
-        attrs['employeeType'] = employeeType
-        attrs['employeeNumber'] = dNumber
-        attrs['o'] = ou
-        attrs['businessCategory'] = businessCategory
-        attrs['pwdReset'] = 'TRUE'
-
-        # Convert our dict to proper syntax using modlist module
-        ldif = modlist.addModlist(attrs)
-
-        # Do the actual synchronous add to the ldapserver
-        dn = buildDN(username)
-        l.add_s(dn,ldif)
+        try:
+            if pos == len(buf):
+                raise ValueError("need more input")
+            row, pos = decoder.raw_decode(buf, pos)
         
-        # Log user creation
-        logging.info("user added to ldap: {0}" \
-                        .format(username))
-        print("SUCCESS: User {0} added to ldap" \
-                        .format(username))
+        except ValueError:
+            # Entry continues in the next chunk
+            chunk = f.read(chunksize)
+            if not chunk:
+                raise ValueError("truncated useractions in input file")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
         
-        # Its nice to the server to disconnect
-        l.unbind_s()
+        yield row
         
-    except ldap.LDAPError, e:
-        print("ERROR: Could not add user to ldap: " \
-                    "{0}".format(e))
-        logging.error("ldap add failed for user: " \
-                    "{0}".format(username))
-        result = "ERROR: Could not create ldap user"
-        return result
+        # Drop what we already decoded
+        if pos > chunksize:
+            buf = buf[pos:]
+            pos = 0
+
+def dispatch(l, row):
+    """Run the action requested by one input row and return its result"""
     
-    result = "SUCCESS: User added to ldap"
+    # Select what needs to be done
+    if row["action"] == 'create':
+        result = create(l, str(row["username"]), 
+                        str(row["givenName"]), str(row["fullName"]), 
+                        str(row["sn"]), str(row["employeeType"]), 
+                        str(row["DNumber"]), 
+                        str(row["primO"]), str(row["businessCategory"]), 
+                        str(row["userPassword"]), 
+                        row.get("userPasswordHash"))
+    elif row["action"] == 'update':
+        result = update(l, str(row["username"]), str(row["newusername"]), 
+                        str(row["uidNumber"]), 
+                        str(row["gidNumber"]), str(row["givenName"]), 
+                        str(row["fullName"]), str(row["sn"]), 
+                        str(row["employeeType"]), str(row["DNumber"]), 
+                        str(row["primO"]), str(row["businessCategory"]))
+    elif row["action"] == 'delete':
+        result = delete(l, str(row["username"]))
+    else:
+        echo("ERROR: unrecognized action")                
+        logging.error("unrecognized action")
+        result = "ERROR: Unrecognized action"
     
     return result
-    
-def update(username, newusername, uidNumber, gidNumber, 
-            givenName, fullName, sn, employeeType, dNumber, 
-            ou, businessCategory):
-    """This function updates user attributes 
-    and renames users if needed"""  
 
-    # Check if any of the arguments are missing
-    params = locals()
+def actionType(row):
+    """Name the action of a row, telling renames from updates"""
     
-    for _item in params:
-        if str(params[_item]) == "":
-            print("ERROR: unable to update user {0} because {1} is missing " \
-                    "a value".format(username, _item))
-            logging.error("unable to update user {0} because {1} is missing " \
-                            "a value".format(username, _item))
-            result = "ERROR: Missing an expected input value for " \
-                        + _item + " in input file"
-            return result
+    if row.get("action") == 'update' and \
+            row.get("username") != row.get("newusername"):
+        return 'rename'
+    
+    return str(row.get("action"))
 
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
+def rowAccounts(row):
+    """Return the usernames an input row touches"""
     
-    # Catch the condition when LDAP connection failed
-    if not l:
-        result = "ERROR: unable to connect to LDAP server"
-        return result
+    accounts = set([str(row.get("username", ""))])
+    if row.get("action") == 'update':
+        accounts.add(str(row.get("newusername", "")))
     
-    # Do a quick check if the user exists
-    if not findUser(l, username):
-        print("ERROR: user does not exist: {0}".format(username))
-        logging.error("user does not exist: {0}".format(username))
-        result = "ERROR: user could not be found!"
-        return result
+    return accounts
+
+def runSequential(l, rows):
+    """Run (index, row) pairs one after another, yield their results"""
     
-    # rename if new username is different
-    if username != newusername:
-        # First check if both usernames are of the same type
-        userType = getUserType(username)
-        
-        if userType != getUserType(newusername):
-            print("ERROR: unable to rename user {0} to {1} because " \
-                    "they are of different type".format(username, newusername))
-            logging.error("unable to rename user {0} to {1} because " \
-                    "they are of different type".format(username, newusername))
-            result = "ERROR: won't rename users across different types"
-            return result
+    for index, row in rows:
+        # Nothing is held back, so a flush request needs no work
+        if row is None:
+            continue
+        start = time.time()
+        result = dispatch(l, row)
+        yield index, row, result, time.time() - start
 
-        # Rename the user
-        try:
-            # Check if the new user name already exists
-            if findUser(l, newusername):
-                print("ERROR: cannot rename user - user already exists: {0}" \
-                        .format(newusername))
-                logging.error("cannot rename user - user already exists: {0}" \
-                                .format(newusername))
-                result = "ERROR: newusername already taken!"
-                return result
-            
-            # Get the dn of our user
-            dn = buildDN(username)
-            
-            # you can safely ignore the results returned as an exception 
-            # will be raised if the rename doesn't work.
-            l.rename_s(dn, 'uid=' + newusername)
-            
-            logging.info("user {0} renamed to {1} in ldap" \
-                            .format(username, newusername))
-            
-        except Exception as e:
-            print("ERROR: unknown error while renaming user: {0}".format(e))
-            logging.error("unknown error while attempting to rename user")
-            result = "ERROR: Could not rename ldap user"
-            
-        findUser(l, newusername)
-        print("INFO: user {0} renamed to {1} in ldap" \
-                .format(username, newusername))
-        logging.info("user {0} fully renamed to {1} in ldap" \
-                        .format(username, newusername))
-        
-    # Rename or not, update attributes or disable
-    try:
-        # Build the list of modifications
-        # We do not reset passwords here!
-        mod_attrs = [
-            ( ldap.MOD_REPLACE, 'givenName', givenName ),
-            ( ldap.MOD_REPLACE, 'cn', fullName ),
-            ( ldap.MOD_REPLACE, 'sn', sn ),
-            ( ldap.MOD_REPLACE, 'uid', newusername ),
-            ( ldap.MOD_REPLACE, 'mail', newusername + MAILDOMAIN ),
-            ( ldap.MOD_REPLACE, 'employeeType', employeeType ),
-            ( ldap.MOD_REPLACE, 'employeeNumber', dNumber ),
-            ( ldap.MOD_REPLACE, 'o', ou ),
-            ( ldap.MOD_REPLACE, 'businessCategory', businessCategory )
-        ]
-        if containsPosixAccount(l,username):
-            mod_attrs = [
-                ( ldap.MOD_REPLACE, 'uidNumber', uidNumber ),
-                ( ldap.MOD_REPLACE, 'gidNumber', gidNumber ),
-                ( ldap.MOD_REPLACE, 'homeDirectory', "/home/" + newusername )
-            ]
+def runPipelined(l, rows, window):
+    """Run (index, row) pairs with up to window writes in flight
+    
+    Results are yielded in input order once all writes of a row
+    have been answered by the server."""
+    
+    pipe = LDAPPipeline(l, window)
+    pending = collections.deque()
+    
+    for index, row in rows:
+        # Flush request, see runWorkers()
+        if row is None:
+            pipe.drain()
+            while pending:
+                yield pipe.finish(*pending.popleft())
+            continue
         
-        # Get the dn of our user
-        dn = buildDN(newusername)
+        start = time.time()
+        pipe.beginRow(index, rowAccounts(row))
+        pending.append((index, row, dispatch(pipe, row), start))
         
-        # Do the actual modifications
-        l.modify_s(dn, mod_attrs)
+        # Hand back every finished row at the head of the queue
+        while pending and not pipe.busy(pending[0][0]):
+            yield pipe.finish(*pending.popleft())
+    
+    pipe.drain()
+    while pending:
+        yield pipe.finish(*pending.popleft())
 
-        # Its nice to the server to disconnect when done
-        l.unbind_s()
+def runTransactions(l, rows, size):
+    """Run (index, row) pairs with their writes grouped in transactions
+    
+    Up to size rows share one LDAP transaction. Results are yielded in 
+    input order once the transaction of their row has ended."""
+    
+    txn = LDAPTransaction(l, size)
+    pending = collections.deque()
+    
+    for index, row in rows:
+        # Flush request, see runWorkers()
+        if row is None:
+            txn.commit()
+            while pending:
+                yield txn.finish(*pending.popleft())
+            continue
         
-    except ldap.LDAPError, e:
-        print("ERROR: Could not update user in ldap: {0}".format(e))
-        logging.error("ldap update failed for: {0}".format(username))
-        result = "ERROR: Could not update ldap user"
-        return result
+        start = time.time()
+        if txn.beginRow(index, rowAccounts(row)):
+            while pending:
+                yield txn.finish(*pending.popleft())
+        pending.append((index, row, dispatch(txn, row), start))
     
-    except Exception as e:
-        print("ERROR: unknown error while updating user: {0}".format(e))
-        logging.error("unknown error while updating user")
-        result = "ERROR: Could not update ldap user"
-            
-    print("SUCCESS: user {0} updated in ldap".format(newusername))
-    logging.info("User {0} updated ldap".format(dn))
-    result = "SUCCESS: User updated in ldap"
+    txn.commit()
+    while pending:
+        yield txn.finish(*pending.popleft())
+
+# Fields a row needs for each action, see dispatch()
+CREATEFIELDS = ('username', 'givenName', 'fullName', 'sn', 'employeeType', 
+                'DNumber', 'primO', 'businessCategory', 'userPassword')
+UPDATEFIELDS = ('username', 'newusername', 'uidNumber', 'gidNumber', 
+                'givenName', 'fullName', 'sn', 'employeeType', 'DNumber', 
+                'primO', 'businessCategory')
+
+# Net row of a group of actions that cancel each other out
+NOCHANGE = {}
+
+class ActionGroup(object):
+    """Consecutive actions on one account, following its renames"""
     
-    return result
+    __slots__ = ('rows', 'names')
     
+    def __init__(self):
+        self.rows = []
+        self.names = []
+
+def netAction(rows):
+    """Collapse the (index, row) pairs of an ActionGroup
     
-def delete(username):
-    """This function deletes a user from ldap"""
+    Returns the single row that has the same effect as all of them,
+    NOCHANGE when they cancel out, or None when they have to run one
+    by one."""
     
-    # Check if the argument is missing
-    if str(username) == "":
-        print("ERROR: unable to delete user because username argument " \
-                "is missing a value")
-        logging.error("unable to delete user because username argument " \
-                        "is missing a value")
-        result = "ERROR: Missing an expected input value for username " \
-                    "in input file"
-        return result
-            
-    # We have all we need, connect to LDAP
-    l = ldapConnect()
-        
-    # Catch the condition when LDAP connection failed
-    if not l:
-        result = "ERROR: unable to connect to LDAP server"
-        return result
+    if len(rows) == 1:
+        return rows[0][1]
     
-    # Do a quick check if the user exists
-    if not findUser(l, username):
-        print("ERROR: user does not exist: {0}".format(username))
-        logging.error("user does not exist: {0}".format(username))
-        result = "ERROR: user could not be found!"
-        return result
+    actions = [row["action"] for index, row in rows]
+    first = rows[0][1]
+    last = rows[-1][1]
     
-    # Delete the user if all is OK
-    try:
-        # Get the dn of our user
-        dn = buildDN(username)
+    # Leave rows with missing values alone so they report it themselves
+    for index, row in rows:
+        fields = CREATEFIELDS if row["action"] == 'create' else UPDATEFIELDS
+        if row["action"] != 'delete' and \
+                any(str(row.get(field, "")) == "" for field in fields):
+            return None
+    
+    # Renames have to stay within one user type
+    for index, row in rows:
+        if row["action"] == 'update' and \
+                getUserType(str(row["username"])) != \
+                getUserType(str(row["newusername"])):
+            return None
+    
+    # Anything followed by a delete
+    if actions[-1] == 'delete':
+        if actions[0] == 'create':
+            return NOCHANGE
+        return {"action": "delete", "username": first["username"]}
+    
+    if any(action != 'update' for action in actions[1:]):
+        return None
+    
+    # Create and updates become one add with the final attributes
+    if actions[0] == 'create':
+        net = dict(last)
+        net["action"] = 'create'
+        net["username"] = last["newusername"]
+        net["userPassword"] = first["userPassword"]
+        return net
+    
+    # Repeated updates and chained renames
+    net = dict(last)
+    net["username"] = first["username"]
+    
+    return net
+
+def coalesceRows(rows):
+    """Plan the net effect of a batch of (index, row) pairs
+    
+    Rows are grouped by account, following username -> newusername
+    chains. A group is closed by a delete, or when a later row needs a
+    name the group renamed away from or into. Returns a list of
+    (row, indexes) in the order they have to run, where row is the net
+    row of the rows at indexes, or NOCHANGE."""
+    
+    plans = []
+    # lowercase name -> open group holding it, or renamed away from it
+    active = {}
+    released = {}
+    
+    def close(group):
+        """Plan a finished group"""
         
-        l.delete_s(dn)
-        logging.info("user {0} deleted from ldap".format(dn))
+        for name in group.names:
+            if active.get(name) is group:
+                del active[name]
+            if released.get(name) is group:
+                del released[name]
         
-        # Its nice to the server to disconnect when done
-        l.unbind_s()
+        net = netAction(group.rows)
+        if net is None:
+            plans.extend((row, [index]) for index, row in group.rows)
+        else:
+            plans.append((net, [index for index, row in group.rows]))
+            if len(group.rows) > 1:
+                logging.debug("coalesced rows {0} into one {1}".format(
+                    [index for index, row in group.rows], 
+                    net.get("action", "no-op")))
+    
+    for index, row in rows:
+        action = row.get("action")
+        if action not in ('create', 'update', 'delete'):
+            plans.append((row, [index]))
+            continue
         
-    except ldap.LDAPError, e:
-        print("ERROR: Could not delete user in ldap: {0}".format(e))
-        logging.error("ldap delete failed for {0}".format(dn))
-        result = "ERROR: Could not delete ldap user"
-        return result
-
-    except Exception as e:
-        print("ERROR: unknown error while deleting user: {0}".format(e))
-        logging.error("unknown error while deleting user")
-        result = "ERROR: Could not delete ldap user"
+        name = str(row.get("username", "")).lower()
+        newname = name
+        if action == 'update':
+            newname = str(row.get("newusername", "")).lower()
         
-    print("SUCCESS: user {0} deleted from ldap".format(username))
-    logging.info("user {0} fully deleted from ldap".format(dn))
-    result = "SUCCESS: User deleted from ldap"
+        # The row depends on a group that gave up or wants its names
+        for key in set([name, newname]):
+            if key in released:
+                close(released[key])
+        if newname != name and newname in active and \
+                active[newname] is not active.get(name):
+            close(active[newname])
+        
+        group = active.get(name)
+        if group is None:
+            group = ActionGroup()
+            active[name] = group
+            group.names.append(name)
+        group.rows.append((index, row))
+        
+        if newname != name:
+            del active[name]
+            released[name] = group
+            active[newname] = group
+            group.names.append(newname)
+        
+        if action == 'delete':
+            close(group)
     
-    return result
+    # Whatever is still open is independent of each other
+    opened = []
+    for group in active.values() + released.values():
+        if group not in opened:
+            opened.append(group)
+    for group in sorted(opened, key=lambda group: group.rows[0][0]):
+        close(group)
+    
+    return plans
 
-def readConfig(config_file):
-    """Function to import the config file"""
+def runCoalesced(rows, run):
+    """Run the net effect of (index, row) pairs, yield their results
     
-    if config_file[-3:] == ".py":
-        config_file = config_file[:-3]
-    settings = __import__(config_file, globals(), locals(), [])
+    run is called with the (index, row) pairs of the net rows. Every
+    input row gets the result of the net row it was folded into, in
+    input order. This assumes the feed is consistent with the directory:
+    when a net row fails, all rows folded into it report that error."""
     
-    # Read settings and set globals
-    try: 
+    rows = list(rows)
+    plans = coalesceRows(rows)
+    
+    # Net rows to send, numbered as run() expects them
+    work = [plan for plan in plans if plan[0] is not NOCHANGE]
+    
+    # index -> (result, seconds)
+    results = {}
+    for plan in plans:
+        if plan[0] is NOCHANGE:
+            for index in plan[1]:
+                results[index] = ("SUCCESS: No net change in this batch", 0.0)
+    
+    ready = 0
+    for number, net, result, seconds in run(enumerate(net for net, indexes 
+                                                        in work)):
+        for index in work[number][1]:
+            results[index] = (result, seconds)
+        
+        # Hand back what is complete at the head of the input
+        while ready < len(rows) and ready in results:
+            yield (ready, rows[ready][1]) + results.pop(ready)
+            ready += 1
+    
+    while ready < len(rows):
+        yield (ready, rows[ready][1]) + results.pop(ready)
+        ready += 1
+
+def rowTarget(row):
+    """Sort key of a row: the OU and the DN of the entry it acts on"""
+    
+    dn = buildDN(str(row.get("username", ""))).lower()
+    
+    return dn.split(',', 1)[-1], dn
+
+def scheduleRows(rows):
+    """Order (index, row) pairs for locality on the server
+    
+    Rows that share an account, directly or through a chain of renames, 
+    are joined with a union-find and keep their input order among 
+    themselves. The chains are merged by the rowTarget() of their next 
+    row, so the rows go out grouped by OU and in DN order within it, as 
+    far as the chains allow."""
+    
+    # lowercase account -> account it was joined with
+    parent = {}
+    
+    def find(account):
+        parent.setdefault(account, account)
+        while parent[account] != account:
+            # Path halving keeps the chains short
+            parent[account] = parent[parent[account]]
+            account = parent[account]
+        return account
+    
+    rows = list(rows)
+    for index, row in rows:
+        roots = [find(account.lower()) for account in rowAccounts(row)]
+        for root in roots[1:]:
+            parent[root] = roots[0]
+    
+    # root account -> rows in input order
+    chains = collections.OrderedDict()
+    for item in rows:
+        root = find(str(item[1].get("username", "")).lower())
+        chains.setdefault(root, collections.deque()).append(item)
+    
+    heap = [(rowTarget(chain[0][1]), number, chain) 
+            for number, chain in enumerate(chains.values())]
+    heapq.heapify(heap)
+    
+    while heap:
+        key, number, chain = heapq.heappop(heap)
+        yield chain.popleft()
+        if chain:
+            heapq.heappush(heap, (rowTarget(chain[0][1]), number, chain))
+
+def runScheduled(rows, run, window):
+    """Run (index, row) pairs in scheduleRows() order, yield results in 
+    input order
+    
+    Up to window rows are reordered at a time, fewer when a flush is 
+    requested, so the input is still streamed."""
+    
+    # Indexes in input order and number -> index of the rows handed to run
+    arrived = collections.deque()
+    numbers = {}
+    
+    def feed():
+        number = itertools.count()
+        chunk = []
+        
+        def release():
+            # Numbered as run() expects them
+            for index, row in scheduleRows(chunk):
+                numbered = next(number)
+                numbers[numbered] = index
+                yield numbered, row
+            del chunk[:]
+        
+        for index, row in rows:
+            # Flush request, run what we hold first
+            if row is None:
+                for item in release():
+                    yield item
+                yield index, row
+                continue
+            arrived.append(index)
+            chunk.append((index, row))
+            if len(chunk) >= window:
+                for item in release():
+                    yield item
+        
+        for item in release():
+            yield item
+    
+    # index -> (index, row, result, seconds) of rows done out of order
+    done = {}
+    for number, row, result, seconds in run(feed()):
+        index = numbers.pop(number)
+        done[index] = (index, row, result, seconds)
+        while arrived and arrived[0] in done:
+            yield done.pop(arrived.popleft())
+
+def runFiltered(rows, run, check, done=None):
+    """Run the rows check() lets through and yield all in input order
+    
+    check(index, row) returns the result of a row that is not to run, or 
+    None. done(index, row, result) is called for every row in input 
+    order. Rows that do not run keep their place in the output."""
+    
+    # Rows in input order: (index, row, result) with no result yet for the 
+    # rows handed to run()
+    pending = collections.deque()
+    
+    def feed():
+        number = 0
+        for index, row in rows:
+            result = check(index, row)
+            pending.append((index, row, result))
+            if result is None:
+                yield number, row
+                number += 1
+    
+    def held():
+        while pending and pending[0][2] is not None:
+            index, row, result = pending.popleft()
+            if done:
+                done(index, row, result)
+            yield index, row, result, 0.0
+    
+    for number, row, result, seconds in run(feed()):
+        for item in held():
+            yield item
+        index, row, none = pending.popleft()
+        if done:
+            done(index, row, result)
+        yield index, row, result, seconds
+    
+    for item in held():
+        yield item
+
+def runJournaled(rows, run, journal, resume=False, reject=None):
+    """Run the rows the journal does not know as applied and record all
+    
+    A row is skipped when its content matches the last successful action 
+    on its account, or with resume when the journal has it done at the 
+    same index. reject(index, row) returns the result of a row that is 
+    not to run at all, or None, like the check of runFiltered()."""
+    
+    # index -> content hash of the rows not recorded yet
+    digests = {}
+    
+    def check(index, row):
+        digests[index] = journal.digest(row)
+        result = reject(index, row) if reject else None
+        if result is not None:
+            return result
+        return journal.skip(index, row, digests[index], resume)
+    
+    def done(index, row, result):
+        journal.record(index, row, digests.pop(index), result)
+    
+    return runFiltered(rows, run, check, done)
+
+def runNotified(rows, run, notifier):
+    """Run the rows and queue an email for every account created or renamed"""
+    
+    for index, row, result, seconds in run(rows):
+        if result.startswith("SUCCESS"):
+            if row.get("action") == 'create':
+                notifier.created(str(row["username"]))
+            elif actionType(row) == 'rename':
+                notifier.renamed(str(row["username"]), 
+                                    str(row["newusername"]))
+        yield index, row, result, seconds
+
+def preflight(rows):
+    """Check a whole batch before any of it runs
+    
+    Finds missing values, unknown actions, renames across user types, 
+    creates of a username or renames to a newusername that the batch 
+    already has in use, and uidNumbers or DNumbers claimed by two 
+    accounts. Returns {index: result} of the rows to reject; a rejected 
+    row is taken as not run when checking the rows after it."""
+    
+    rejected = {}
+    # Accounts the batch has created or renamed to and not deleted since
+    taken = set()
+    # (field, value) -> account holding it, and the reverse
+    owners = {}
+    held = collections.defaultdict(list)
+    
+    def release(account):
+        for key in held.pop(account, []):
+            if owners.get(key) == account:
+                del owners[key]
+    
+    for index, row in rows:
+        action = row.get("action")
+        fields = {'create': CREATEFIELDS, 'update': UPDATEFIELDS, 
+                    'delete': ('username',)}.get(action)
+        
+        if fields is None:
+            rejected[index] = "ERROR: Unrecognized action"
+            continue
+        
+        missing = [field for field in fields if field not in row or 
+                    unicode(row[field]) == ""]
+        if missing:
+            rejected[index] = "ERROR: Missing an expected input value " \
+                                "for " + missing[0] + " in input file"
+            continue
+        
+        username = unicode(row["username"]).lower()
+        newusername = username
+        if action == 'update':
+            newusername = unicode(row["newusername"]).lower()
+        
+        if username != newusername:
+            if getUserType(str(row["username"])) != \
+                    getUserType(str(row["newusername"])):
+                rejected[index] = "ERROR: won't rename users across " \
+                                    "different types"
+                continue
+            if newusername in taken:
+                rejected[index] = "ERROR: newusername already taken in " \
+                                    "this batch!"
+                continue
+        
+        if action == 'create' and username in taken:
+            rejected[index] = "ERROR: username already created in this batch!"
+            continue
+        
+        # Values an account claims, a rename keeps them with the account
+        claims = [('DNumber', unicode(row["DNumber"]))] \
+                    if action != 'delete' else []
+        if action == 'update':
+            claims.append(('uidNumber', unicode(row["uidNumber"])))
+        
+        conflict = None
+        for key in claims:
+            owner = owners.get(key)
+            if owner is not None and owner not in (username, newusername):
+                conflict = "ERROR: {0} already used by {1} in this " \
+                            "batch!".format(key[0], owner)
+                break
+        if conflict:
+            rejected[index] = conflict
+            continue
+        
+        # Book what the row will do for the rows after it
+        if action == 'delete':
+            taken.discard(username)
+            release(username)
+            continue
+        
+        if username != newusername:
+            taken.discard(username)
+            held[newusername].extend(held.pop(username, []))
+            for key in held[newusername]:
+                owners[key] = newusername
+        
+        taken.add(newusername)
+        for key in claims:
+            if key not in owners:
+                owners[key] = newusername
+                held[newusername].append(key)
+    
+    for index in sorted(rejected):
+        logging.error("row {0} rejected before running: {1}" \
+                        .format(index, rejected[index]))
+    logging.info("pre-flight rejected {0} row(s)".format(len(rejected)))
+    
+    return rejected
+
+class ExternalSort(object):
+    """Sort (key, item) pairs holding at most runsize of them in memory
+    
+    Full runs are sorted and spilled to temporary files, iterating merges
+    the runs back in key order. Items with equal keys keep the order they 
+    were added in."""
+    
+    def __init__(self, runsize=None):
+        self.runsize = runsize or SORTRUN
+        self.run = []
+        self.files = []
+        self.added = 0
+    
+    def add(self, key, item):
+        self.run.append((key, self.added, item))
+        self.added += 1
+        if len(self.run) >= self.runsize:
+            self.spill()
+    
+    def spill(self):
+        self.run.sort()
+        f_run = tempfile.TemporaryFile()
+        for entry in self.run:
+            cPickle.dump(entry, f_run, cPickle.HIGHEST_PROTOCOL)
+        f_run.seek(0)
+        self.files.append(f_run)
+        self.run = []
+    
+    def load(self, f_run):
+        try:
+            while True:
+                yield cPickle.load(f_run)
+        except EOFError:
+            f_run.close()
+    
+    def __iter__(self):
+        self.run.sort()
+        runs = [self.load(f_run) for f_run in self.files] + [iter(self.run)]
+        for key, added, item in heapq.merge(*runs):
+            yield key, item
+
+def mergeJoin(left, right):
+    """Join two streams of (key, item) sorted by key
+    
+    Yields (key, lefts, rights) for every key, with the items of each side
+    under that key."""
+    
+    left = iter(left)
+    right = iter(right)
+    end = object()
+    nextleft = next(left, end)
+    nextright = next(right, end)
+    
+    while nextleft is not end or nextright is not end:
+        if nextright is end or \
+                (nextleft is not end and nextleft[0] <= nextright[0]):
+            key = nextleft[0]
+        else:
+            key = nextright[0]
+        
+        lefts = []
+        while nextleft is not end and nextleft[0] == key:
+            lefts.append(nextleft[1])
+            nextleft = next(left, end)
+        rights = []
+        while nextright is not end and nextright[0] == key:
+            rights.append(nextright[1])
+            nextright = next(right, end)
+        
+        yield key, lefts, rights
+
+def sortEntries(entries, runsize=None):
+    """Sort (dn, entry) pairs of users by uid for reconcileRows()"""
+    
+    present = ExternalSort(runsize)
+    for dn, entry in entries:
+        attrs, posix = entryAttrs(entry)
+        if attrs.get('uid'):
+            present.add(attrs['uid'][0].lower(), (attrs, posix))
+    
+    return present
+
+def reconcileRows(rows, present, runsize=None):
+    """Actions that make the directory match a full snapshot of users
+    
+    rows is the snapshot in the input format, present the users in the 
+    directory from sortEntries(). The snapshot is sorted by uid as well 
+    and the two are merge-joined: users only in the snapshot are created, users only in 
+    the directory deleted and users in both updated where an attribute 
+    differs. A user created and one deleted with the same DNumber (and 
+    of the same type) are renamed instead."""
+    
+    counts = collections.Counter()
+    
+    wanted = ExternalSort(runsize)
+    for row in rows:
+        # A snapshot lists who should exist, deletes are simply left out
+        if row.get("action") != 'delete':
+            wanted.add(str(row.get("username", "")).lower(), row)
+    
+    # Users only on one side, by DNumber to find the renames
+    creates = ExternalSort(runsize)
+    deletes = ExternalSort(runsize)
+    
+    for key, lefts, rights in mergeJoin(wanted, present):
+        if len(rights) > 1:
+            logging.warning("user {0} has multiple entries in ldap" \
+                            .format(key))
+        
+        if lefts and rights:
+            # The last row for a user in the snapshot wins
+            row = dict(lefts[-1], action='update')
+            row["newusername"] = row["username"]
+            attrs, posix = rights[0]
+            
+            # Rows with missing values go through to report them
+            if all(field in row for field in UPDATEFIELDS):
+                new_attrs = managedAttrs(*[str(row[field]) for field in 
+                                            UPDATEFIELDS[1:]] + [posix])
+                if not modlist.modifyModlist(attrs, new_attrs):
+                    counts['unchanged'] += 1
+                    continue
+            
+            counts['update'] += 1
+            yield row
+        
+        elif lefts:
+            creates.add(str(lefts[-1].get("DNumber", "")), lefts[-1])
+        
+        else:
+            attrs, posix = rights[0]
+            deletes.add(attrs.get('employeeNumber', [''])[0], attrs)
+    
+    for dNumber, lefts, rights in mergeJoin(creates, deletes):
+        if dNumber and len(lefts) == 1 and len(rights) == 1 and \
+                getUserType(str(lefts[0]["username"])) == \
+                getUserType(rights[0]['uid'][0]):
+            row = dict(lefts[0], action='update')
+            row["newusername"] = row["username"]
+            row["username"] = rights[0]['uid'][0]
+            counts['rename'] += 1
+            yield row
+            continue
+        
+        for row in lefts:
+            counts['create'] += 1
+            yield dict(row, action='create')
+        for attrs in rights:
+            counts['delete'] += 1
+            yield {"action": 'delete', "username": attrs['uid'][0]}
+    
+    logging.info("reconcile: {0}".format(", ".join("{0} {1}".format(n, what) 
+                                        for what, n in sorted(counts.items()))))
+
+def directoryEntries(pool, pagesize=1000):
+    """Page through the users of the student, guest and employee OUs"""
+    
+    bases = []
+    for ou in (STUDENTOU, GUESTOU, EMPOU):
+        base = ou.lstrip(',')
+        if base not in bases:
+            bases.append(base)
+    
+    with pool.session() as l:
+        if not l.connect():
+            raise ldap.SERVER_DOWN("unable to connect to LDAP server")
+        for base in bases:
+            for dn, entry in pagedSearch(l, base, "(uid=*)", 
+                                    list(USERATTRS) + ['objectClass'], 
+                                    pagesize):
+                yield dn, entry
+
+def runLDIF(l, rows, f_ldif):
+    """Write the create rows of (index, row) pairs as LDIF, yield results
+    
+    No user is sent to the server, the LDIF file is meant to be loaded
+    offline with slapadd. With IDCOUNTER set their uidNumbers are still 
+    taken from the counter entry over l."""
+    
+    writer = ldif.LDIFWriter(f_ldif)
+    seen = set()
+    
+    for index, row in rows:
+        start = time.time()
+        if row["action"] == 'create':
+            result = emitUser(l, writer, seen, str(row["username"]), 
+                                str(row["givenName"]), str(row["fullName"]), 
+                                str(row["sn"]), str(row["employeeType"]), 
+                                str(row["DNumber"]), 
+                                str(row["primO"]), str(row["businessCategory"]), 
+                                str(row["userPassword"]), 
+                                row.get("userPasswordHash"))
+        else:
+            echo("ERROR: only create actions can be exported to LDIF")
+            logging.error("{0} action skipped for LDIF export" \
+                            .format(row["action"]))
+            result = "ERROR: Only create actions can be bulk loaded"
+        
+        yield index, row, result, time.time() - start
+
+def runPooled(pool, rows, runner):
+    """Run (index, row) pairs with runner on a session from the pool"""
+    
+    with pool.session() as l:
+        for item in runner(l, rows):
+            yield item
+
+def shardOf(account, workers):
+    """Stable worker number for an account"""
+    
+    return (zlib.crc32(account.lower()) & 0xffffffff) % workers
+
+def runWorkers(pool, rows, workers, runner):
+    """Run (index, row) pairs on several worker threads
+    
+    Rows are sharded by a stable hash of the username, so all actions
+    for one account run in order on the same worker. A rename pins both
+    names to the worker of the old name. Results are merged back and
+    yielded in input order."""
+    
+    inboxes = [Queue.Queue(maxsize=100) for _ in range(workers)]
+    results = Queue.Queue()
+    errors = []
+    
+    # Rows handed to and finished by every worker
+    sent = [0] * workers
+    done = [0] * workers
+    progress = threading.Condition()
+    
+    def work(shard):
+        """Worker thread: run the rows of one shard on its own session"""
+        
+        inbox = inboxes[shard]
+        try:
+            with pool.session() as l:
+                for item in runner(l, iter(inbox.get, None)):
+                    results.put(item)
+                    with progress:
+                        done[shard] += 1
+                        progress.notify_all()
+        
+        except Exception as e:
+            logging.critical("worker {0} failed: {1}".format(shard, e))
+            errors.append(e)
+            # Keep taking rows so the feeder does not get stuck
+            with progress:
+                done[shard] = float('inf')
+                progress.notify_all()
+            for item in iter(inbox.get, None):
+                pass
+        
+        finally:
+            results.put(None)
+    
+    def feed():
+        """Feeder thread: hand every row to the worker of its accounts"""
+        
+        # Worker of accounts that took part in a rename
+        routes = {}
+        
+        try:
+            for index, row in rows:
+                # Flush request, every worker hands back what it holds
+                if row is None:
+                    for inbox in inboxes:
+                        inbox.put((None, None))
+                    continue
+                
+                accounts = rowAccounts(row)
+                shard = routes.get(str(row.get("username", "")).lower())
+                if shard is None:
+                    shard = shardOf(str(row.get("username", "")), workers)
+                
+                if len(accounts) > 1:
+                    for account in accounts:
+                        key = account.lower()
+                        other = routes.get(key, shardOf(account, workers))
+                        
+                        # Let the other worker finish with this account
+                        if other != shard:
+                            inboxes[other].put((None, None))
+                            with progress:
+                                while done[other] < sent[other]:
+                                    progress.wait()
+                        routes[key] = shard
+                
+                sent[shard] += 1
+                inboxes[shard].put((index, row))
+        
+        except Exception as e:
+            logging.critical("unable to read actions: {0}".format(e))
+            errors.append(e)
+        
+        finally:
+            for inbox in inboxes:
+                inbox.put(None)
+    
+    threads = [threading.Thread(target=work, args=(shard,)) 
+                for shard in range(workers)]
+    threads.append(threading.Thread(target=feed))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    
+    # Merge the results back into input order
+    waiting = []
+    expected = 0
+    running = workers
+    
+    while running:
+        item = results.get()
+        if item is None:
+            running -= 1
+            continue
+        heapq.heappush(waiting, item)
+        while waiting and waiting[0][0] == expected:
+            yield heapq.heappop(waiting)
+            expected += 1
+    
+    if errors:
+        raise errors[0]
+
+class Batch(object):
+    """Actions from one spool file, connection or stream awaiting results
+    
+    write is called with every row, its result and seconds, close once 
+    the batch has ended and every row is answered."""
+    
+    def __init__(self, write, close=None):
+        self.write = write
+        self.close = close
+        self.pending = 0
+        self.ended = False
+        self.failed = False
+        self.lock = threading.Lock()
+    
+    def add(self):
+        with self.lock:
+            self.pending += 1
+    
+    def answer(self, row, result, seconds=0.0):
+        with self.lock:
+            self.write(row, result, seconds)
+            self.pending -= 1
+            self.check()
+    
+    def end(self, failed=False):
+        with self.lock:
+            self.ended = True
+            self.failed = self.failed or failed
+            self.check()
+    
+    def check(self):
+        if self.ended and not self.pending and self.close:
+            close, self.close = self.close, None
+            close()
+
+def serve(source, run, queuesize=1000):
+    """Take actions continuously until stopped and run them with run
+    
+    source is a spool directory, unix:PATH for a UNIX socket or - for 
+    NDJSON on stdin. Results are streamed back to where the action came 
+    from. On SIGTERM or SIGINT no more actions are taken, the ones 
+    already accepted are run to the end."""
+    
+    inbox = Queue.Queue(queuesize)
+    stop = threading.Event()
+    # index -> Batch of the rows handed to run()
+    batches = {}
+    # Stops submit() from queueing behind the end marker
+    gate = threading.Lock()
+    closed = []
+    
+    def submit(row, batch):
+        """Queue a row for running, waits while the queue is full"""
+        
+        if not isinstance(row, dict) or "action" not in row or \
+                "username" not in row:
+            batch.add()
+            batch.answer(row if isinstance(row, dict) else {}, 
+                            "ERROR: unable to parse action")
+            return
+        
+        batch.add()
+        with gate:
+            if closed:
+                batch.answer(row, "ERROR: service is shutting down")
+                return
+            inbox.put((row, batch))
+    
+    def rows():
+        for index in itertools.count():
+            try:
+                item = inbox.get_nowait()
+            except Queue.Empty:
+                # Hand back what the runners hold before waiting for more
+                yield None, None
+                item = inbox.get()
+            if item is None:
+                return
+            row, batches[index] = item
+            yield index, row
+    
+    def results():
+        for index, row, result, seconds in run(rows()):
+            batches.pop(index).answer(row, result, seconds)
+            countResult(row, result, seconds)
+    
+    if source == '-':
+        sources = [streamSource(sys.stdin, sys.stdout, submit, stop)]
+    elif source.startswith('unix:'):
+        sources = [socketSource(source[len('unix:'):], submit, stop)]
+    else:
+        sources = [spoolSource(source, submit, stop)]
+    
+    def shutdown(signum, frame):
+        logging.info("received signal {0}, draining".format(signum))
+        stop.set()
+    
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    
+    runner = threading.Thread(target=results, name='results')
+    runner.daemon = True
+    runner.start()
+    logging.info("serving actions from {0}".format(source))
+    
+    # Joins with a timeout leave the main thread free for the signals
+    while not closed:
+        for thread in sources:
+            thread.join(0.5)
+        
+        if stop.is_set() or not any(t.is_alive() for t in sources):
+            # Spool files and connections being read are read to the end
+            for thread in sources:
+                while getattr(thread, 'drain', False) and thread.is_alive():
+                    thread.join(0.5)
+            with gate:
+                closed.append(True)
+                inbox.put(None)
+    
+    while runner.is_alive():
+        runner.join(0.5)
+    logging.info("stopped serving actions from {0}".format(source))
+
+def startThread(target, name, *args):
+    """Start a daemon thread"""
+    
+    thread = threading.Thread(target=target, name=name, args=args)
+    thread.daemon = True
+    thread.start()
+    
+    return thread
+
+def writeJSONResult(f, row, result, seconds):
+    """Write the result of a row as one JSON line"""
+    
+    f.write(json.dumps({"action": row.get("action"), 
+                        "username": row.get("username"), 
+                        "result": result, 
+                        "seconds": round(seconds, 6)}) + "\n")
+    f.flush()
+
+def readLines(f, submit, batch, stop=None):
+    """Submit every NDJSON line of f as a row of batch"""
+    
+    for line in iter(f.readline, ''):
+        if stop is not None and stop.is_set():
+            break
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        submit(row, batch)
+
+def streamSource(f_in, f_out, submit, stop):
+    """Read NDJSON actions from f_in, write results as JSON lines to f_out"""
+    
+    def read():
+        batch = Batch(functools.partial(writeJSONResult, f_out))
+        readLines(f_in, submit, batch, stop)
+        batch.end()
+    
+    return startThread(read, 'stdin')
+
+def socketSource(path, submit, stop):
+    """Take NDJSON actions from connections to a UNIX socket
+    
+    Every connection gets the results of its actions back as JSON lines 
+    and is closed once its actions are answered."""
+    
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    listener.settimeout(0.5)
+    
+    def handle(conn):
+        f_conn = conn.makefile('rwb')
+        
+        def close():
+            f_conn.close()
+            conn.close()
+        
+        batch = Batch(functools.partial(writeJSONResult, f_conn), close)
+        try:
+            readLines(f_conn, submit, batch, stop)
+        except socket.error as e:
+            logging.error("connection failed: {0}".format(e))
+        batch.end()
+    
+    def accept():
+        try:
+            while not stop.is_set():
+                try:
+                    conn, address = listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                startThread(handle, 'connection', conn)
+        finally:
+            listener.close()
+            os.unlink(path)
+    
+    thread = startThread(accept, 'socket')
+    # Wait for the socket to be removed when stopping
+    thread.drain = True
+    
+    return thread
+
+def spoolSource(path, submit, stop, interval=1.0):
+    """Take the actions of JSON or NDJSON files dropped into a directory
+    
+    The results of NAME are written to NAME.csv, then NAME is renamed to 
+    NAME.done (or NAME.failed if it could not be read). Files should be 
+    moved into the directory once complete; names starting with a dot 
+    are left alone."""
+    
+    # Files read or waiting for results
+    active = set()
+    
+    def process(name):
+        in_file = os.path.join(path, name)
+        f_in = open(in_file, 'rb')
+        f_out = open(in_file + '.csv', 'wb')
+        writer = csv.writer(f_out)
+        writer.writerow( ['action','username','result','seconds'] )
+        
+        def write(row, result, seconds):
+            writer.writerow( [row.get("action"), row.get("username"), result, 
+                                "{0:.6f}".format(seconds)] )
+        
+        def close():
+            f_out.close()
+            suffix = '.failed' if batch.failed else '.done'
+            os.rename(in_file, in_file + suffix)
+            logging.info("finished spool file: {0}".format(name))
+            active.discard(name)
+        
+        batch = Batch(write, close)
+        logging.info("reading spool file: {0}".format(name))
+        try:
+            for row in readActions(f_in):
+                submit(row, batch)
+        except Exception as e:
+            echo("ERROR: unable to read spool file {0}: {1}".format(name, e))
+            logging.error("unable to read spool file {0}: {1}" \
+                            .format(name, e))
+            batch.failed = True
+        finally:
+            f_in.close()
+        batch.end()
+    
+    def poll():
+        while not stop.is_set():
+            names = sorted(name for name in os.listdir(path) 
+                            if name.endswith(('.json', '.ndjson')) and 
+                            not name.startswith('.') and name not in active)
+            for name in names:
+                if stop.is_set():
+                    break
+                active.add(name)
+                try:
+                    process(name)
+                except (IOError, OSError) as e:
+                    logging.error("unable to process spool file {0}: {1}" \
+                                    .format(name, e))
+            stop.wait(interval)
+    
+    thread = startThread(poll, 'spool')
+    # A file being read is read to the end when stopping
+    thread.drain = True
+    
+    return thread
+
+def create(l, username, givenName, fullName, sn, employeeType, dNumber, ou, 
+            businessCategory, userPassword, userPasswordHash=None):
+    """This function adds users to openldap"""
+    
+    # Check if any of the parameters are missing
+    params = locals()
+    
+    for _item in params:
+        if _item != 'l' and str(params[_item]) == "":
+            echo("ERROR: unable to create user {0} because {1} is missing " \
+                    "a value".format(username, _item))
+            logging.error("unable to create user {0} because {1} is missing " \
+                            "a value".format(username, _item))
+            result = "ERROR: Missing an expected input value for " + _item \
+                        + " in input file"
+            return result
+
+    # We have all we need, make sure the shared session is bound
+    if not l.connect():
+        result = "ERROR: unable to connect to LDAP server"
+        return result
+        
+    # Do a quick check if the user already exists
+    if findUser(l, username):
+        echo("ERROR: cannot create user - user already exists: {0}" \
+                .format(username))
+        logging.error("cannot create user - user already exists: {0}" \
+                .format(username))
+        result = "ERROR: username already taken!"
+        return result
+        
+    # Create new user if it does not exist
+    try:
+        
+        # Build a dict for the "body" of the user object
+        attrs = buildUserAttrs(l, username, givenName, fullName, sn, 
+                                employeeType, dNumber, ou, businessCategory, 
+                                userPassword, userPasswordHash)
+        if attrs is None:
+            result = "ERROR: Could not allocate a uidNumber"
+            return result
+
+        # Convert our dict to proper syntax using modlist module
+        ldif = modlist.addModlist(attrs)
+
+        # Do the actual synchronous add to the ldapserver
+        dn = buildDN(username)
+        l.add_s(dn,ldif)
+        if UIDINDEX is not None:
+            def added():
+                UIDINDEX.add(username, dn, 'uidNumber' in attrs)
+                UIDINDEX.store(username, attrs)
+            l.afterWrite(added)
+        
+        # Log user creation
+        logging.info("user added to ldap: {0}" \
+                        .format(username))
+        echo("SUCCESS: User {0} added to ldap" \
+                        .format(username))
+        
+    except ldap.LDAPError, e:
+        echo("ERROR: Could not add user to ldap: " \
+                    "{0}".format(e))
+        logging.error("ldap add failed for user: " \
+                    "{0}".format(username))
+        result = "ERROR: Could not create ldap user"
+        return result
+    
+    result = "SUCCESS: User added to ldap"
+    
+    return result
+    
+def buildUserAttrs(l, username, givenName, fullName, sn, employeeType, 
+                    dNumber, ou, businessCategory, userPassword, 
+                    userPasswordHash=None):
+    """Build the dict for the "body" of a new user object
+    
+    The password is hashed here unless a hash was computed ahead, see 
+    hashPasswords(). With IDCOUNTER set the user is a posixAccount with 
+    a uidNumber taken over l, None is returned when there is none."""
+    
+    attrs = {}
+    attrs['objectclass'] = ['top','person','organizationalPerson',
+                            'inetOrgPerson','duPerson', 'qmailUser']
+    attrs['uid'] = username
+    if userPasswordHash:
+        attrs['userPassword'] = userPasswordHash
+    else:
+        with METRICS.timer('hash'):
+            attrs['userPassword'] = hashPassword(userPassword)
+    attrs['givenName'] = givenName
+    attrs['cn'] = fullName
+    attrs['sn'] = sn
+    attrs['mail'] = username + MAILDOMAIN
+    attrs['employeeType'] = employeeType
+    attrs['employeeNumber'] = dNumber
+    attrs['o'] = ou
+    attrs['businessCategory'] = businessCategory
+    attrs['pwdReset'] = 'TRUE'
+    
+    # Make it a posixAccount with its own group when we hand out IDs
+    if IDALLOCATOR is not None:
+        uidNumber = IDALLOCATOR.allocate(l)
+        if uidNumber is None:
+            echo("ERROR: no uidNumber for user {0}".format(username))
+            logging.error("unable to allocate a uidNumber for user: " \
+                            "{0}".format(username))
+            return None
+        attrs['objectclass'].append('posixAccount')
+        attrs['uidNumber'] = str(uidNumber)
+        attrs['gidNumber'] = str(uidNumber)
+        attrs['homeDirectory'] = "/home/" + username
+    
+    return attrs
+
+def hashSHA(password, iterations=None):
+    """Unsalted SHA-1, as OpenLDAP's {SHA}"""
+    
+    return '{SHA}' + base64.b64encode(hashlib.sha1(password).digest())
+
+def hashSSHA(password, iterations=None):
+    """Salted SHA-1, as OpenLDAP's {SSHA}"""
+    
+    salt = os.urandom(8)
+    digest = hashlib.sha1(password + salt).digest()
+    
+    return '{SSHA}' + base64.b64encode(digest + salt)
+
+def hashPBKDF2(password, iterations):
+    """PBKDF2 with HMAC-SHA256, as the pw-pbkdf2 module of OpenLDAP"""
+    
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    
+    # The module uses the adapted base64 alphabet of passlib
+    ab64 = lambda data: base64.b64encode(data).replace('+', '.').rstrip('=')
+    
+    return '{PBKDF2-SHA256}' + str(iterations) + '$' + ab64(salt) + '$' + \
+            ab64(digest)
+
+# userPassword schemes by the name PASSWORDSCHEME gives
+PASSWORDSCHEMES = {
+    'SHA': hashSHA,
+    'SSHA': hashSSHA,
+    'PBKDF2-SHA256': hashPBKDF2
+}
+
+def hashPassword(password, scheme=None, iterations=None):
+    """Hash a password for userPassword, by default as the settings say"""
+    
+    return PASSWORDSCHEMES[scheme or PASSWORDSCHEME](password, 
+                                            iterations or PASSWORDITERATIONS)
+
+def hashTask(task):
+    """Hash (password, scheme, iterations) in a pool process, with timing"""
+    
+    start = time.time()
+    userPasswordHash = hashPassword(*task)
+    
+    return userPasswordHash, time.time() - start
+
+def ignoreInterrupts():
+    """Leave Ctrl-C to the main process, see hashPasswords()"""
+    
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def hashPasswords(rows, pool, window):
+    """Hash the passwords of create rows in a process pool ahead of use
+    
+    (index, row) pairs are passed on in order, create rows as a copy 
+    with userPasswordHash set. Up to window rows are hashed ahead, so 
+    hashing overlaps with the writes of the rows before them."""
+    
+    pending = collections.deque()
+    
+    def finish(index, row, job):
+        if job is not None:
+            userPasswordHash, seconds = job.get()
+            METRICS.observe('phase', 'hash', seconds)
+            row = dict(row, userPasswordHash=userPasswordHash)
+        return index, row
+    
+    for index, row in rows:
+        # Flush request, see runWorkers()
+        if row is None:
+            while pending:
+                yield finish(*pending.popleft())
+            yield index, row
+            continue
+        
+        job = None
+        if row.get("action") == 'create' and row.get("userPassword"):
+            job = pool.apply_async(hashTask, ((str(row["userPassword"]), 
+                                    PASSWORDSCHEME, PASSWORDITERATIONS),))
+        pending.append((index, row, job))
+        
+        while pending and (len(pending) >= window or pending[0][2] is None 
+                            or pending[0][2].ready()):
+            yield finish(*pending.popleft())
+    
+    while pending:
+        yield finish(*pending.popleft())
+
+def managedAttrs(newusername, uidNumber, gidNumber, givenName, fullName, sn, 
+                    employeeType, dNumber, ou, businessCategory, posix):
+    """Build the attributes update() sets on an existing user"""
+    
+    # We do not reset passwords here!
+    attrs = {
+        'givenName': [givenName],
+        'cn': [fullName],
+        'sn': [sn],
+        'uid': [newusername],
+        'mail': [newusername + MAILDOMAIN],
+        'employeeType': [employeeType],
+        'employeeNumber': [dNumber],
+        'o': [ou],
+        'businessCategory': [businessCategory]
+    }
+    
+    if posix:
+        attrs['uidNumber'] = [uidNumber]
+        attrs['gidNumber'] = [gidNumber]
+        attrs['homeDirectory'] = ["/home/" + newusername]
+    
+    return attrs
+
+def emitUser(l, writer, seen, username, givenName, fullName, sn, 
+                employeeType, dNumber, ou, businessCategory, userPassword, 
+                userPasswordHash=None):
+    """This function writes a new user as an LDIF entry for slapadd
+    
+    l is only used to take uidNumbers from IDCOUNTER."""
+    
+    # Check if any of the parameters are missing
+    params = locals()
+    
+    for _item in params:
+        if _item not in ('l', 'writer', 'seen') and \
+                str(params[_item]) == "":
+            echo("ERROR: unable to export user {0} because {1} is missing " \
+                    "a value".format(username, _item))
+            logging.error("unable to export user {0} because {1} is missing " \
+                            "a value".format(username, _item))
+            result = "ERROR: Missing an expected input value for " + _item \
+                        + " in input file"
+            return result
+    
+    # Nobody is there to refuse a duplicate, slapadd would stop on it
+    if username.lower() in seen:
+        echo("ERROR: cannot export user - user already exported: {0}" \
+                .format(username))
+        logging.error("cannot export user - user already exported: {0}" \
+                .format(username))
+        result = "ERROR: username already taken!"
+        return result
+    
+    # The uidNumbers come from the counter entry as for online creates
+    if IDALLOCATOR is not None and not l.connect():
+        result = "ERROR: unable to connect to LDAP server"
+        return result
+    
+    attrs = buildUserAttrs(l, username, givenName, fullName, sn, employeeType, 
+                            dNumber, ou, businessCategory, userPassword, 
+                            userPasswordHash)
+    if attrs is None:
+        result = "ERROR: Could not allocate a uidNumber"
+        return result
+    
+    # LDIFWriter wants a list of values for every attribute
+    entry = dict((attr, value if isinstance(value, list) else [value]) 
+                    for attr, value in attrs.items())
+    
+    dn = buildDN(username)
+    writer.unparse(dn, entry)
+    seen.add(username.lower())
+    logging.info("user written to ldif: {0}".format(dn))
+    
+    result = "SUCCESS: User written to LDIF"
+    
+    return result
+
+def update(l, username, newusername, uidNumber, gidNumber, 
+            givenName, fullName, sn, employeeType, dNumber, 
+            ou, businessCategory):
+    """This function updates user attributes 
+    and renames users if needed"""  
+
+    # Check if any of the arguments are missing
+    params = locals()
+    
+    for _item in params:
+        if _item != 'l' and str(params[_item]) == "":
+            echo("ERROR: unable to update user {0} because {1} is missing " \
+                    "a value".format(username, _item))
+            logging.error("unable to update user {0} because {1} is missing " \
+                            "a value".format(username, _item))
+            result = "ERROR: Missing an expected input value for " \
+                        + _item + " in input file"
+            return result
+
+    # We have all we need, make sure the shared session is bound
+    if not l.connect():
+        result = "ERROR: unable to connect to LDAP server"
+        return result
+    
+    # Read the entry as it is right now, before anything is written, so 
+    # the rename and the modify follow each other without a read between
+    old_attrs, posix = lookupUser(l, username, read=True)
+    
+    if old_attrs is None:
+        echo("ERROR: user does not exist: {0}".format(username))
+        logging.error("user does not exist: {0}".format(username))
+        result = "ERROR: user could not be found!"
+        return result
+    
+    # rename if new username is different
+    if username != newusername:
+        # First check if both usernames are of the same type
+        userType = getUserType(username)
+        
+        if userType != getUserType(newusername):
+            echo("ERROR: unable to rename user {0} to {1} because " \
+                    "they are of different type".format(username, newusername))
+            logging.error("unable to rename user {0} to {1} because " \
+                    "they are of different type".format(username, newusername))
+            result = "ERROR: won't rename users across different types"
+            return result
+
+        # Check if the new user name already exists
+        if findUser(l, newusername):
+            echo("ERROR: cannot rename user - user already exists: {0}" \
+                    .format(newusername))
+            logging.error("cannot rename user - user already exists: {0}" \
+                            .format(newusername))
+            result = "ERROR: newusername already taken!"
+            return result
+    
+    if username != newusername:
+        # Rename the user
+        try:
+            # Get the dn of our user
+            dn = buildDN(username)
+            
+            # you can safely ignore the results returned as an exception 
+            # will be raised if the rename doesn't work.
+            l.rename_s(dn, 'uid=' + newusername)
+            if UIDINDEX is not None:
+                l.afterWrite(functools.partial(UIDINDEX.rename, username, 
+                                newusername, buildDN(newusername)))
+            
+            # The new RDN replaced the old uid of the entry
+            old_attrs['uid'] = [uid for uid in old_attrs.get('uid', []) 
+                                if uid.lower() != username.lower()] + \
+                                [newusername]
+            
+            logging.debug("user {0} renamed to {1} in ldap" \
+                            .format(username, newusername))
+            
+        except Exception as e:
+            echo("ERROR: unknown error while renaming user: {0}".format(e))
+            logging.error("unknown error while attempting to rename user")
+            result = "ERROR: Could not rename ldap user"
+            
+        echo("INFO: user {0} renamed to {1} in ldap" \
+                .format(username, newusername))
+        logging.info("user {0} fully renamed to {1} in ldap" \
+                        .format(username, newusername))
+        
+    # Rename or not, update attributes or disable
+    try:
+        # Get the dn of our user
+        dn = buildDN(newusername)
+        
+        # Build the attributes the user should end up with
+        new_attrs = managedAttrs(newusername, uidNumber, gidNumber, 
+                                    givenName, fullName, sn, employeeType, 
+                                    dNumber, ou, businessCategory, posix)
+        
+        # Only send the attributes that actually differ
+        mod_attrs = modlist.modifyModlist(old_attrs, new_attrs)
+        
+        if not mod_attrs and username == newusername:
+            echo("UNCHANGED: user {0} already up to date in ldap" \
+                    .format(username))
+            logging.info("user {0} unchanged in ldap".format(dn))
+            result = "UNCHANGED: User already up to date in ldap"
+            return result
+        
+        # Do the actual modifications
+        if mod_attrs:
+            l.modify_s(dn, mod_attrs)
+        if UIDINDEX is not None:
+            l.afterWrite(functools.partial(UIDINDEX.store, newusername, 
+                                            new_attrs))
+        
+    except ldap.LDAPError, e:
+        echo("ERROR: Could not update user in ldap: {0}".format(e))
+        logging.error("ldap update failed for: {0}".format(username))
+        result = "ERROR: Could not update ldap user"
+        return result
+    
+    except Exception as e:
+        echo("ERROR: unknown error while updating user: {0}".format(e))
+        logging.error("unknown error while updating user")
+        result = "ERROR: Could not update ldap user"
+            
+    echo("SUCCESS: user {0} updated in ldap".format(newusername))
+    logging.info("User {0} updated ldap".format(dn))
+    result = "SUCCESS: User updated in ldap"
+    
+    return result
+    
+    
+def delete(l, username):
+    """This function deletes a user from ldap"""
+    
+    # Check if the argument is missing
+    if str(username) == "":
+        echo("ERROR: unable to delete user because username argument " \
+                "is missing a value")
+        logging.error("unable to delete user because username argument " \
+                        "is missing a value")
+        result = "ERROR: Missing an expected input value for username " \
+                    "in input file"
+        return result
+            
+    # We have all we need, make sure the shared session is bound
+    if not l.connect():
+        result = "ERROR: unable to connect to LDAP server"
+        return result
+    
+    # Do a quick check if the user exists
+    if not findUser(l, username):
+        echo("ERROR: user does not exist: {0}".format(username))
+        logging.error("user does not exist: {0}".format(username))
+        result = "ERROR: user could not be found!"
+        return result
+    
+    # Delete the user if all is OK
+    try:
+        # Get the dn of our user
+        dn = buildDN(username)
+        
+        l.delete_s(dn)
+        if UIDINDEX is not None:
+            l.afterWrite(functools.partial(UIDINDEX.remove, username))
+        logging.info("user {0} deleted from ldap".format(dn))
+        
+    except ldap.LDAPError, e:
+        echo("ERROR: Could not delete user in ldap: {0}".format(e))
+        logging.error("ldap delete failed for {0}".format(dn))
+        result = "ERROR: Could not delete ldap user"
+        return result
+
+    except Exception as e:
+        echo("ERROR: unknown error while deleting user: {0}".format(e))
+        logging.error("unknown error while deleting user")
+        result = "ERROR: Could not delete ldap user"
+        
+    echo("SUCCESS: user {0} deleted from ldap".format(username))
+    logging.info("user {0} fully deleted from ldap".format(dn))
+    result = "SUCCESS: User deleted from ldap"
+    
+    return result
+
+def readConfig(config_file):
+    """Function to import the config file"""
+    
+    if config_file[-3:] == ".py":
+        config_file = config_file[:-3]
+    settings = __import__(config_file, globals(), locals(), [])
+    
+    # Read settings and set globals
+    try: 
         global LDAPSERVER
+        global LDAPREPLICAS
         global USER
         global PASSWORD
         global baseDN
@@ -453,8 +2350,17 @@ def readConfig(config_file):
         global STUDENTOU
         global GUESTOU
         global EMPOU
+        global IDCOUNTER
+        global SMTPSERVER
+        global SMTPPORT
+        global SMTPTIMEOUT
+        global MAILFROM
+        global PASSWORDSCHEME
+        global PASSWORDITERATIONS
         
         LDAPSERVER = settings.LDAPSERVER
+        # Optional, older settings files have no replicas
+        LDAPREPLICAS = list(getattr(settings, 'LDAPREPLICAS', []))
         USER = settings.USER
         PASSWORD = base64.b64decode(settings.PASSWORD)
         baseDN = settings.BASEDN
@@ -464,102 +2370,1978 @@ def readConfig(config_file):
         STUDENTOU = settings.STUDENTOU
         GUESTOU = settings.GUESTOU
         EMPOU = settings.EMPOU
+        # Optional, new users are not posixAccounts without it
+        IDCOUNTER = getattr(settings, 'IDCOUNTER', '')
+        # Optional, only --notify needs them
+        SMTPSERVER = getattr(settings, 'SMTPSERVER', '')
+        SMTPPORT = int(getattr(settings, 'SMTPPORT', 25))
+        SMTPTIMEOUT = float(getattr(settings, 'SMTPTIMEOUT', 30))
+        MAILFROM = getattr(settings, 'MAILFROM', '')
+        # Optional, older settings files keep unsalted SHA-1
+        PASSWORDSCHEME = getattr(settings, 'PASSWORDSCHEME', 'SHA')
+        PASSWORDITERATIONS = int(getattr(settings, 'PASSWORDITERATIONS', 
+                                            100000))
+        if PASSWORDSCHEME not in PASSWORDSCHEMES:
+            raise ValueError("unknown PASSWORDSCHEME " + PASSWORDSCHEME)
+
+    except Exception as e:
+        echo("ERROR: unable to parse the settings file: {0}".format(e))
+        logging.error("settings file error: {0}".format(e))
+        return False
+    
+    # Users may be classified differently under the new settings
+    getUserType.cache.clear()
+    buildDN.cache.clear()
+        
+    return True
+
+def memoized(function):
+    """Cache the results of a function of one string
+    
+    The cache is dropped as a whole once it holds MEMOSIZE results and by
+    readConfig(), as the results depend on the settings."""
+    
+    cache = {}
+    
+    @functools.wraps(function)
+    def wrapper(arg):
+        try:
+            return cache[arg]
+        except KeyError:
+            if len(cache) >= MEMOSIZE:
+                cache.clear()
+            result = cache[arg] = function(arg)
+            return result
+    
+    wrapper.cache = cache
+    return wrapper
+
+@memoized
+def getUserType(username):
+    """ Function to determine the type of a user"""
+
+    if STUPATTERN in username:
+        userType = "STU"
+    elif GSTPATTERN == username[0:-4]:
+        userType = "GST"
+    else:
+        userType = "EMP"
+
+    return userType
+    
+
+def ldapConnect(server=None):
+    """Function to bind to LDAP server, the provider unless server is given"""
+
+    ldap_user = USER
+    ldap_secret = PASSWORD
+    ldap_server = server or LDAPSERVER
+    
+    try:
+        # Open a connection to the LDAP server
+        start = time.time()
+        l = ldap.initialize(ldap_server)
+        l.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+        
+        # Bind with a user that has rights to add/update objects
+        l.simple_bind_s(ldap_user, ldap_secret)
+        METRICS.observe('phase', 'bind', time.time() - start)
+    
+    except ldap.LDAPError, e:
+        echo("ERROR: Could not establish LDAP connection: {0}".format(e))
+        logging.error("problem binding to ldap LDAP server")
+        return False
+        
+    return l
+
+class LDAPSession(object):
+    """A bound LDAP connection that is reused for a whole batch
+
+    Attribute access is passed through to the underlying LDAPObject.
+    Synchronous calls (the *_s methods) that fail because the server
+    went away or timed out are retried after binding again."""
+
+    # Errors after which the connection is rebuilt and the call retried
+    RETRY_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+    RETRIES = 1
+    
+    # Searches that may be answered by a read replica
+    READ_CALLS = ('search_s', 'search_ext_s')
+    # Writes whose accounts are read from the provider for a while after
+    WRITE_CALLS = ('add_s', 'modify_s', 'rename_s', 'delete_s', 
+                    'add_ext_s', 'modify_ext_s', 'delete_ext_s', 
+                    'add_ext', 'modify_ext', 'rename', 'delete_ext')
+
+    def __init__(self, controller=None, replicas=None):
+        self.conn = None
+        # Optional RateController shared by all sessions of a pool
+        self.controller = controller
+        # Optional ReplicaSet shared by all sessions of a pool
+        self.replicas = replicas
+        # Bound connection to every replica read from, by uri
+        self.readers = {}
+
+    def connect(self):
+        """Bind to the LDAP server unless we already are bound"""
+
+        if not self.conn:
+            self.conn = ldapConnect()
+
+        return bool(self.conn)
+
+    def rebind(self):
+        """Drop the current connection and bind again"""
+
+        self.unbind()
+        logging.info("re-binding to ldap server")
+
+        return self.connect()
+
+    def unbind(self):
+        """Politely disconnect from the server"""
+
+        if self.conn:
+            try:
+                self.conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+            self.conn = None
+        
+        for uri in list(self.readers):
+            self.dropReader(uri)
+
+    def afterWrite(self, callback):
+        """Run callback once the last write succeeded, they are synchronous 
+        here, see LDAPPipeline.afterWrite()"""
+        
+        callback()
+
+    def dropReader(self, uri):
+        """Disconnect from a replica"""
+
+        try:
+            self.readers.pop(uri).unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def bound(self, name):
+        """Look up a method of the connection, SERVER_DOWN without one"""
+        
+        if not self.conn:
+            raise ldap.SERVER_DOWN({'desc': "not bound to the ldap server"})
+        
+        return getattr(self.conn, name)
+
+    def __getattr__(self, name):
+        attr = self.bound(name)
+        if not callable(attr) or not name.endswith('_s') \
+                or name == 'unbind_s':
+            if self.replicas is None or name not in self.WRITE_CALLS:
+                return attr
+            return self.noted(attr)
+
+        def call(*args, **kwargs):
+            with METRICS.timer(name.replace('_ext', '')[:-2]):
+                if self.replicas is not None:
+                    if name in self.READ_CALLS:
+                        return self.read(name, args, kwargs)
+                    if name in self.WRITE_CALLS:
+                        self.replicas.wrote(*args[:2])
+                if self.controller is None:
+                    return self.retry(name, args, kwargs)
+                return self.throttled(name, args, kwargs)
+
+        return call
+
+    def noted(self, attr):
+        """Wrap an asynchronous write to note the account it changes"""
+
+        def call(*args, **kwargs):
+            self.replicas.wrote(*args[:2])
+            return attr(*args, **kwargs)
+
+        return call
+
+    def read(self, name, args, kwargs):
+        """Run a search on the replicas in turn, the provider if none answers"""
+
+        uris = []
+        if self.replicas.routable(args):
+            uris = self.replicas.candidates()
+        
+        for uri in uris:
+            conn = self.readers.get(uri)
+            if conn is None:
+                conn = ldapConnect(uri)
+                if not conn:
+                    self.replicas.failed(uri, "unable to bind")
+                    continue
+                self.readers[uri] = conn
+            try:
+                result = getattr(conn, name)(*args, **kwargs)
+            except ReplicaSet.FAILOVER_ERRORS as e:
+                self.replicas.failed(uri, e)
+                self.dropReader(uri)
+                continue
+            self.replicas.recovered(uri)
+            METRICS.count('read', ('replica',))
+            return result
+
+        METRICS.count('read', ('provider',))
+        if self.controller is None:
+            return self.retry(name, args, kwargs)
+        return self.throttled(name, args, kwargs)
+
+    def retry(self, name, args, kwargs):
+        """Run a call, binding again once if the connection is lost"""
+
+        tries = 0
+        while True:
+            try:
+                return self.bound(name)(*args, **kwargs)
+            except self.RETRY_ERRORS as e:
+                if tries >= self.RETRIES:
+                    raise
+                tries += 1
+                logging.warning("ldap {0} failed with {1}, retrying" \
+                                .format(name, e))
+                if not self.rebind():
+                    raise
+
+    def provider(self, name, *args, **kwargs):
+        """Run a call on LDAPSERVER itself, past any replica or proxy
+        
+        Not throttled, it is meant for the rare calls that must see the 
+        latest state, see IDAllocator."""
+        
+        with METRICS.timer(name.replace('_ext', '')[:-2]):
+            return self.retry(name, args, kwargs)
+
+    def throttled(self, name, args, kwargs, wait=None):
+        """Run a call under the rate controller
+
+        Transient errors are retried with a jittered backoff as often as
+        the controller allows, lost connections are bound again. A
+        caller that has asynchronous requests of its own out passes
+        wait, which frees a slot by collecting one of their answers and
+        returns False once there is nothing left to collect."""
+
+        tries = 0
+        while True:
+            while not self.controller.acquire(blocking=wait is None):
+                if not wait():
+                    self.controller.acquire()
+                    break
+            start = time.time()
+            try:
+                result = self.bound(name)(*args, **kwargs)
+            except RateController.TRANSIENT as e:
+                self.controller.release(time.time() - start, e)
+                if tries >= self.controller.retries:
+                    raise
+                tries += 1
+                logging.warning("ldap {0} failed with {1}, retrying" \
+                                .format(name, e))
+                self.controller.backoff(tries)
+                if isinstance(e, self.RETRY_ERRORS) and not self.rebind():
+                    raise
+                continue
+            except Exception:
+                self.controller.release(time.time() - start)
+                raise
+            self.controller.release(time.time() - start)
+            return result
+
+class QueueHandler(logging.Handler):
+    """Hand log records to a queue instead of writing them
+    
+    The records are formatted as far as needed before they are queued, so 
+    the writing thread does not see arguments that changed since."""
+    
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+    
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+class LogListener(object):
+    """Background thread writing queued log records to a handler"""
+    
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self.thread = threading.Thread(target=self.run, name='log')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
+    
+    def stop(self):
+        """Write what is queued and close the handler"""
+        
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.handler.close()
+
+class JSONFormatter(logging.Formatter):
+    """Format a log record as one JSON object per line"""
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        
+        return json.dumps(entry, sort_keys=True)
+
+# Thread writing openldap.log, see setupLogging()
+LOGLISTENER = None
+
+def setupLogging(level='INFO', format='text', filename='openldap.log'):
+    """Send logging through a queue to a thread that writes the log file
+    
+    Logging calls only queue the record and never wait on the disk."""
+    
+    global LOGLISTENER
+    if LOGLISTENER is not None:
+        return
+    
+    handler = logging.FileHandler(filename)
+    if format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s, %(levelname)s: %(message)s', 
+            datefmt='%Y-%m-%d %H:%M:%S'))
+    
+    queue = Queue.Queue()
+    LOGLISTENER = LogListener(queue, handler)
+    atexit.register(LOGLISTENER.stop)
+    
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(queue))
+    # Records below the level are dropped before they are queued
+    root.setLevel(getattr(logging, level))
+
+def echo(message):
+    """Print a message unless running quiet, or serving on stdout"""
+    
+    if not QUIET:
+        print(message)
+
+class Journal(object):
+    """Append-only record of the outcome of every row
+    
+    Each line holds the index, username, newusername, content hash and 
+    outcome of a row. Lines are flushed as they are written and synced 
+    to disk in batches, so a crash of the host loses at most the last 
+    batch. Rows still in flight when the script dies are not recorded 
+    and run again."""
+    
+    # Outcomes that leave the account as the row describes it
+    APPLIED = ('SUCCESS', 'UNCHANGED', 'SKIPPED')
+    
+    def __init__(self, path, syncrows=100, syncinterval=1.0):
+        # index -> (digest, outcome) of the rows of earlier runs
+        self.rows = {}
+        # account -> digest of the last row applied to it
+        self.accounts = {}
+        
+        try:
+            with open(path, 'rb') as f_journal:
+                for line in f_journal:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 5 or not fields[0].isdigit():
+                        continue
+                    index, username, newusername, digest, outcome = fields
+                    self.rows[int(index)] = (digest, outcome)
+                    if outcome in self.APPLIED:
+                        self.accounts[username] = digest
+                        self.accounts[newusername] = digest
+        except IOError:
+            pass
+        
+        self.f_journal = open(path, 'ab')
+        self.syncrows = syncrows
+        self.syncinterval = syncinterval
+        self.unsynced = 0
+        self.synced = time.time()
+    
+    def digest(self, row):
+        """Content hash of a row"""
+        
+        return hashlib.sha1(json.dumps(row, sort_keys=True)).hexdigest()
+    
+    def skip(self, index, row, digest, resume=False):
+        """Result of a row that needs not run or None
+        
+        Must see the rows in input order: once a row runs, later rows on 
+        its accounts are no longer compared with earlier runs."""
+        
+        accounts = rowAccounts(row)
+        
+        done = self.rows.get(index)
+        if resume and done and done[0] == digest and done[1] in self.APPLIED:
+            return "SKIPPED: Row already done in an earlier run"
+        
+        if all(self.accounts.get(a) == digest for a in accounts):
+            return "SKIPPED: Row already applied in an earlier run"
+        
+        for account in accounts:
+            self.accounts.pop(account, None)
+        
+        return None
+    
+    def record(self, index, row, digest, result):
+        """Append the outcome of a row"""
+        
+        username = row.get("username", "")
+        newusername = username
+        if row.get("action") == 'update':
+            newusername = row.get("newusername", username)
+        
+        self.f_journal.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(index, 
+                username, newusername, digest, result.split(':')[0]))
+        self.f_journal.flush()
+        
+        self.unsynced += 1
+        if self.unsynced >= self.syncrows or \
+                time.time() - self.synced >= self.syncinterval:
+            self.sync()
+    
+    def sync(self):
+        os.fsync(self.f_journal.fileno())
+        self.unsynced = 0
+        self.synced = time.time()
+    
+    def close(self):
+        self.sync()
+        self.f_journal.close()
+
+class Notifier(object):
+    """Background thread sending account emails over one SMTP connection
+    
+    Messages are queued without waiting and sent in batches of whatever 
+    has queued up, on a connection that is kept open between batches and 
+    closed when idle. Temporary failures (4xx answers, lost connections) 
+    are retried with a growing delay, permanent ones are logged."""
+    
+    # Most messages sent per batch, see run()
+    BATCH = 100
+    # Seconds without mail before the connection is closed
+    IDLE = 30
+    # Failures in a row before a batch is given up, and the delay after 
+    # the first of them
+    RETRIES = 5
+    BACKOFF = 1.0
+    # Seconds mail is given up at once after a batch was given up
+    HOLDDOWN = 60
+    
+    def __init__(self, server, port, sender, timeout=30):
+        self.server = server
+        self.port = port
+        self.sender = sender
+        # Seconds a connect or an answer of the server may take
+        self.timeout = timeout
+        self.smtp = None
+        self.downuntil = 0
+        self.queue = Queue.Queue()
+        self.thread = startThread(self.run, 'notify')
+    
+    def created(self, username):
+        self.send(username + MAILDOMAIN, "Your account {0}".format(username), 
+                    "Your account {0} has been created.\n".format(username))
+    
+    def renamed(self, username, newusername):
+        self.send(newusername + MAILDOMAIN, 
+                    "Your account {0}".format(newusername), 
+                    "Your account {0} has been renamed to {1}.\n" \
+                        .format(username, newusername))
+    
+    def send(self, to, subject, body):
+        """Queue a message, never blocks"""
+        
+        message = MIMEText(body)
+        message['Subject'] = subject
+        message['From'] = self.sender
+        message['To'] = to
+        self.queue.put((to, message.as_string()))
+    
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.IDLE)
+            except Queue.Empty:
+                self.disconnect()
+                continue
+            
+            # Take what else is waiting along on the same connection
+            batch = [item]
+            while item is not None and len(batch) < self.BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                batch.append(item)
+            
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            self.deliver(batch)
+            logging.debug("handled {0} notification(s)".format(len(batch)))
+            if stop:
+                self.disconnect()
+                return
+    
+    def deliver(self, batch):
+        """Send a batch of messages, retrying temporary failures
+        
+        Gives up on the rest of the batch after RETRIES failures in a 
+        row, and on the batches queued in the HOLDDOWN after that, so an 
+        unreachable server holds the queue up only so long."""
+        
+        if time.time() < self.downuntil:
+            self.giveUp(len(batch))
+            return
+        
+        delay = self.BACKOFF
+        failures = 0
+        for position, (to, message) in enumerate(batch):
+            while True:
+                try:
+                    if self.smtp is None:
+                        self.smtp = smtplib.SMTP(self.server, self.port, 
+                                                    timeout=self.timeout)
+                    self.smtp.sendmail(self.sender, [to], message)
+                    METRICS.count('mail', ('sent',))
+                    delay = self.BACKOFF
+                    failures = 0
+                    break
+                
+                except (smtplib.SMTPException, socket.error) as e:
+                    if not self.temporary(e):
+                        logging.error("notification to {0} failed: {1}" \
+                                        .format(to, e))
+                        METRICS.count('mail', ('failed',))
+                        break
+                    
+                    failures += 1
+                    logging.warning("notification to {0} failed, attempt " \
+                                    "{1}: {2}".format(to, failures, e))
+                    # The session may be in any state, start a new one
+                    self.disconnect()
+                    if failures >= self.RETRIES:
+                        self.downuntil = time.time() + self.HOLDDOWN
+                        self.giveUp(len(batch) - position)
+                        return
+                    METRICS.count('mail', ('retried',))
+                    time.sleep(delay)
+                    delay *= 2
+    
+    def giveUp(self, count):
+        logging.error("notification server {0} unreachable, dropped {1} " \
+                        "notification(s)".format(self.server, count))
+        for i in xrange(count):
+            METRICS.count('mail', ('failed',))
+    
+    def temporary(self, e):
+        """Tell whether an SMTP failure is worth retrying"""
+        
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 
+                        for code, reason in e.recipients.values())
+        if isinstance(e, smtplib.SMTPResponseException):
+            return 400 <= e.smtp_code < 500
+        # Lost or refused connections
+        return isinstance(e, (smtplib.SMTPServerDisconnected, socket.error))
+    
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                self.smtp.close()
+            self.smtp = None
+    
+    def close(self):
+        """Send what is queued and stop"""
+        
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+class Metrics(object):
+    """Counts, cumulative time and latency histograms of a run
+    
+    Timings are kept per family ('phase' for bind, searches, writes and
+    hashing, 'action' for whole rows) and label, counters per family and
+    a tuple of labels."""
+    
+    # Upper bounds of the histogram buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 
+                1, 2.5, 5, 10)
+    
+    # Prometheus name, label names and help of the counter families, 
+    # others get openldap_FAMILY_total and a label named after the family
+    COUNTERS = {
+        'result': ('openldap_results_total', ('action', 'result'), 
+                    'Rows per action and result'),
+        'read': ('openldap_reads_total', ('server',), 
+                    'Searches per server they went to'),
+        'mail': ('openldap_mails_total', ('outcome',), 
+                    'Emails per outcome'),
+        'idblock': ('openldap_idblocks_total', ('outcome',), 
+                    'uidNumber block allocations per outcome')
+    }
+    
+    def __init__(self):
+        # (family, label) -> [count, seconds, per-bucket counts]
+        self.timings = {}
+        # (family, labels) -> count
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+    
+    def observe(self, family, label, seconds):
+        """Record one timing"""
+        
+        slot = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            timing = self.timings.get((family, label))
+            if timing is None:
+                timing = [0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+                self.timings[(family, label)] = timing
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2][slot] += 1
+    
+    def count(self, family, labels):
+        """Count one event"""
+        
+        with self.lock:
+            self.counters[(family, labels)] += 1
+    
+    @contextmanager
+    def timer(self, label, family='phase'):
+        """Time the body of a with block"""
+        
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(family, label, time.time() - start)
+    
+    def summary(self, elapsed):
+        """Everything recorded as a dict, ready for JSON"""
+        
+        summary = {'seconds': round(elapsed, 6)}
+        
+        for (family, label), (count, seconds, buckets) in \
+                sorted(self.timings.items()):
+            cumulative = [sum(buckets[:i + 1]) for i in xrange(len(buckets))]
+            summary.setdefault(family, {})[label] = {
+                'count': count,
+                'seconds': round(seconds, 6),
+                'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['+Inf'], 
+                                    cumulative))
+            }
+        
+        for (family, labels), count in sorted(self.counters.items()):
+            summary.setdefault(family, {})['/'.join(labels)] = count
+        
+        rows = sum(timing[0] for (family, label), timing 
+                    in self.timings.items() if family == 'action')
+        summary['rows'] = rows
+        summary['rows_per_sec'] = round(rows / elapsed, 3) if elapsed else 0
+        
+        return summary
+    
+    def prometheus(self, elapsed):
+        """Everything recorded in the Prometheus text format"""
+        
+        lines = []
+        names = {'phase': 'openldap_phase_seconds', 
+                    'action': 'openldap_action_seconds'}
+        
+        for family in sorted(set(f for f, label in self.timings)):
+            name = names.get(family, 'openldap_' + family + '_seconds')
+            lines.append("# HELP {0} Time spent per {1}".format(name, family))
+            lines.append("# TYPE {0} histogram".format(name))
+            for (f, label), (count, seconds, buckets) in \
+                    sorted(self.timings.items()):
+                if f != family:
+                    continue
+                total = 0
+                for bound, n in zip(list(self.BUCKETS) + ['+Inf'], buckets):
+                    total += n
+                    lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}' \
+                                    .format(name, family, label, bound, total))
+                lines.append('{0}_sum{{{1}="{2}"}} {3}'.format(name, family, 
+                                                            label, seconds))
+                lines.append('{0}_count{{{1}="{2}"}} {3}'.format(name, family, 
+                                                            label, count))
+        
+        # Every counter family, with the same data as summary()
+        for family in sorted(set(f for f, labels in self.counters)):
+            name, keys, text = self.COUNTERS.get(family, 
+                    ('openldap_' + family + '_total', None, 
+                        'Events per ' + family))
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} counter".format(name))
+            for (f, labels), count in sorted(self.counters.items()):
+                if f != family:
+                    continue
+                names = keys or [family + (str(i) if i else '') 
+                                    for i in xrange(len(labels))]
+                lines.append('{0}{{{1}}} {2}'.format(name, ",".join(
+                                '{0}="{1}"'.format(key, label) 
+                                for key, label in zip(names, labels)), count))
+        
+        lines.append("# HELP openldap_run_seconds Duration of the run")
+        lines.append("# TYPE openldap_run_seconds gauge")
+        lines.append("openldap_run_seconds {0}".format(elapsed))
+        
+        return "\n".join(lines) + "\n"
+
+# Counts and timings of this run, see writeMetrics()
+METRICS = Metrics()
+
+def timed(phase):
+    """Decorator recording the time a function takes as a phase"""
+    
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    
+    return decorate
+
+def countResult(row, result, seconds):
+    """Add the result of a row to the metrics"""
+    
+    METRICS.observe('action', actionType(row), seconds)
+    METRICS.count('result', (actionType(row), result.split(':')[0]))
+
+def writeMetrics(path, format, elapsed):
+    """Write the metrics of the run as JSON or Prometheus text"""
+    
+    try:
+        with open(path, 'wb') as f_metrics:
+            if format == 'prometheus':
+                f_metrics.write(METRICS.prometheus(elapsed))
+            else:
+                json.dump(METRICS.summary(elapsed), f_metrics, indent=2, 
+                            sort_keys=True)
+        logging.info("wrote metrics to {0}".format(path))
+    
+    except IOError as e:
+        echo("ERROR: unable to write metrics file: {0}".format(e))
+        logging.error("unable to write metrics file {0}".format(path))
+
+class RateController(object):
+    """AIMD control of the load we put on the ldap server
+
+    Limits the number of operations in flight over all sessions and,
+    once the server pushed back, their rate. The limits grow a little
+    with every quick answer and are halved on busy, unavailable or
+    timeout errors and on answers slower than the target latency."""
+
+    # Errors that are worth trying again after a while
+    TRANSIENT = (ldap.BUSY, ldap.UNAVAILABLE, ldap.TIMEOUT, 
+                    ldap.TIMELIMIT_EXCEEDED, ldap.SERVER_DOWN)
+
+    def __init__(self, ceiling=1, maxrate=0, target=1.0, retries=5, 
+                    backoff=0.5, maxbackoff=30):
+        # Operations in flight, starting low and growing to the ceiling
+        self.ceiling = max(1, ceiling)
+        self.limit = 1.0
+        self.inflight = 0
+        # Operations per second, 0 means no limit
+        self.maxrate = maxrate
+        self.rate = maxrate
+        self.target = target
+        self.retries = retries
+        self.base = backoff
+        self.maxbackoff = maxbackoff
+        self.cond = threading.Condition()
+        self.next = 0.0
+        self.answers = 0
+        # Smoothed latency and throughput of the answers
+        self.latency = 0.0
+        self.throughput = 0.0
+        self.lastdone = time.time()
+
+    def acquire(self, blocking=True):
+        """Wait for a free slot in the window and a send time"""
+
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.inflight += 1
+
+            # Space the requests out when a rate is in force
+            delay = 0
+            if self.rate:
+                now = time.time()
+                self.next = max(self.next, now) + 1.0 / self.rate
+                delay = self.next - 1.0 / self.rate - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return True
+
+    def release(self, latency, error=None):
+        """Book an answer and adjust the limits"""
+
+        with self.cond:
+            self.inflight -= 1
+            now = time.time()
+
+            elapsed = max(now - self.lastdone, 1e-6)
+            if self.throughput:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+                self.throughput = 0.8 * self.throughput + 0.2 / elapsed
+            else:
+                self.latency = latency
+                self.throughput = 1.0 / elapsed
+            self.lastdone = now
+
+            congested = isinstance(error, self.TRANSIENT) or \
+                        latency > self.target
+
+            # Back off at most once per window of answers
+            self.answers += 1
+            if congested and self.answers >= int(self.limit):
+                self.answers = 0
+                self.limit = max(1.0, self.limit / 2)
+                self.rate = max(1.0, (self.rate or self.throughput) / 2)
+                logging.warning("ldap server congested, limiting to {0} " \
+                                "operations in flight at {1:.1f}/s" \
+                                .format(int(self.limit), self.rate))
+            elif not congested:
+                self.limit = min(self.ceiling, self.limit + 1.0 / self.limit)
+                if self.rate:
+                    self.rate += 1.0
+                    # Lift the rate limit once it no longer holds us back
+                    if self.maxrate:
+                        self.rate = min(self.rate, self.maxrate)
+                    elif self.rate > 2 * self.throughput:
+                        self.rate = 0
+
+            self.cond.notify_all()
+
+    def backoff(self, attempt):
+        """Sleep a jittered, exponentially growing time"""
+
+        time.sleep(random.uniform(0, min(self.maxbackoff, 
+                                            self.base * 2 ** attempt)))
+
+class ReplicaSet(object):
+    """Read replicas taking turns at answering searches
+    
+    A replica that fails is left out for HOLDDOWN seconds. After that the 
+    next read binds to it again, which doubles as its health check. With 
+    a window, reads of an account that was written to in the last window
+    seconds go to the provider so they see the write."""
+    
+    # Errors after which a read moves on to the next replica
+    FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE, 
+                        ldap.BUSY)
+    HOLDDOWN = 30.0
+    
+    # A uid in a DN or a search filter
+    UIDPATTERN = re.compile(r'\buid=([^,()&|!*]+)', re.IGNORECASE)
+    
+    def __init__(self, uris, window=0):
+        self.uris = list(uris)
+        self.window = window
+        self.turn = itertools.count()
+        # uri -> time until which it is left out
+        self.down = {}
+        # uid -> time of the last write to it
+        self.written = {}
+        self.lock = threading.Lock()
+    
+    def candidates(self):
+        """Healthy replicas, starting with the one whose turn it is"""
+        
+        now = time.time()
+        healthy = [uri for uri in self.uris if self.down.get(uri, 0) <= now]
+        if not healthy:
+            return healthy
+        start = next(self.turn) % len(healthy)
+        
+        return healthy[start:] + healthy[:start]
+    
+    def failed(self, uri, error):
+        with self.lock:
+            self.down[uri] = time.time() + self.HOLDDOWN
+        logging.warning("replica {0} failed, leaving it out for {1}s: {2}" \
+                        .format(uri, self.HOLDDOWN, error))
+    
+    def recovered(self, uri):
+        if uri in self.down:
+            with self.lock:
+                if self.down.pop(uri, None):
+                    logging.info("replica {0} is answering again".format(uri))
+    
+    def wrote(self, dn, newrdn=None):
+        """Note the accounts a write to dn (renamed to newrdn) changes"""
+        
+        if not self.window:
+            return
+        
+        now = time.time()
+        with self.lock:
+            # Forget what the replicas have long caught up with
+            if len(self.written) > 100000:
+                self.written = dict((uid, when) for uid, when in 
+                                    self.written.items() 
+                                    if now - when < self.window)
+            for uid in self.UIDPATTERN.findall(dn.split(',')[0]):
+                self.written[uid.lower()] = now
+            if isinstance(newrdn, basestring):
+                for uid in self.UIDPATTERN.findall(newrdn):
+                    self.written[uid.lower()] = now
+    
+    def routable(self, args):
+        """Whether a search with these arguments may go to a replica"""
+        
+        if not self.window:
+            return True
+        
+        base = args[0].split(',')[0] if args else ''
+        searchFilter = args[2] if len(args) > 2 else ''
+        now = time.time()
+        
+        for uid in self.UIDPATTERN.findall(base + searchFilter):
+            if now - self.written.get(uid.lower(), 0) < self.window:
+                return False
+        
+        return True
 
-    except Exception as e:
-        print("ERROR: unable to parse the settings file: {0}".format(e))
-        return False
+class IDAllocator(object):
+    """Hand out uidNumbers from a counter entry in the directory
+    
+    The uidNumber of the counter entry holds the next free number. Each 
+    thread takes a block of numbers at a time, moving the counter on 
+    with a compare-and-swap modify (delete the value read, add the new 
+    one) that the server rejects when someone else moved it first, and 
+    then hands the block out without asking the server. Numbers left in 
+    a block when the script ends are not used."""
+    
+    # Lost races for one block before giving up
+    RETRIES = 10
+    
+    def __init__(self, dn, block=100):
+        self.dn = dn
+        self.block = block
+        # Per thread: [next number, end of block]
+        self.local = threading.local()
+    
+    def allocate(self, l):
+        """Next uidNumber of the calling thread, None when none is to be had"""
         
-    return True
+        numbers = getattr(self.local, 'numbers', None)
+        if numbers is None or numbers[0] >= numbers[1]:
+            numbers = self.fetch(l)
+            if numbers is None:
+                return None
+            self.local.numbers = numbers
+        
+        uidNumber = numbers[0]
+        numbers[0] += 1
+        
+        return uidNumber
+    
+    def fetch(self, l):
+        """Take the next block from the counter entry"""
+        
+        for attempt in xrange(self.RETRIES):
+            try:
+                entries = l.provider('search_s', self.dn, ldap.SCOPE_BASE, 
+                                        '(objectClass=*)', ['uidNumber'])
+                start = int(entries[0][1]['uidNumber'][0])
+                l.provider('modify_s', self.dn, 
+                            [(ldap.MOD_DELETE, 'uidNumber', str(start)), 
+                            (ldap.MOD_ADD, 'uidNumber', 
+                                str(start + self.block))])
+            
+            except ldap.NO_SUCH_ATTRIBUTE:
+                # Another allocator moved the counter since we read it
+                METRICS.count('idblock', ('conflict',))
+                time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+                continue
+            
+            except (ldap.LDAPError, LookupError, ValueError) as e:
+                logging.error("unable to read or move the uidNumber " \
+                                "counter {0}: {1}".format(self.dn, e))
+                return None
+            
+            METRICS.count('idblock', ('taken',))
+            logging.debug("took uidNumbers {0} to {1}".format(start, 
+                                                start + self.block - 1))
+            return [start, start + self.block]
+        
+        logging.error("gave up on the uidNumber counter {0} after {1} " \
+                        "lost races".format(self.dn, self.RETRIES))
+        return None
 
-def getUserType(username):
-    """ Function to determine the type of a user"""
+class LDAPPool(object):
+    """Bounded pool of LDAP sessions
 
-    if STUPATTERN in username:
-        userType = "STU"
-    elif GSTPATTERN == username[0:-4]:
-        userType = "GST"
-    else:
-        userType = "EMP"
+    Sessions are created lazily, so a batch that runs its actions one at
+    a time only ever binds once. Concurrent callers block in acquire()
+    until a session is released when all of them are in use."""
 
-    return userType
+    def __init__(self, size=1, controller=None, replicas=None, factory=None):
+        self.size = size
+        self.controller = controller
+        self.replicas = replicas
+        # Makes a new session, see DryRunSession
+        self.factory = factory or \
+                        (lambda: LDAPSession(self.controller, self.replicas))
+        self.created = 0
+        self.idle = Queue.LifoQueue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Get an idle session or a new one if the pool is not full"""
+
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                session = self.factory()
+                self.sessions.append(session)
+                return session
+
+        return self.idle.get()
+
+    def release(self, session):
+        """Hand a session back to the pool"""
+
+        self.idle.put(session)
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a with block"""
+
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def close(self):
+        """Unbind every session the pool has created"""
+
+        for session in self.sessions:
+            session.unbind()
+        logging.info("closed {0} ldap session(s)".format(len(self.sessions)))
+
+class LDAPPipeline(object):
+    """Issue ldap writes asynchronously on one session
+    
+    Stands in for an LDAPSession while the actions run: add_s, modify_s,
+    rename_s and delete_s are sent with the message-id based calls and
+    return immediately, while reads and everything else go straight to
+    the session. Writes of one row are still sent in order, and a row
+    waits for earlier writes to the same accounts before it starts."""
+    
+    # Asynchronous counterparts of the synchronous write calls
+    ASYNC_CALLS = {
+        'add_s': 'add_ext',
+        'modify_s': 'modify_ext',
+        'rename_s': 'rename',
+        'delete_s': 'delete_ext'
+    }
+    
+    # Row result when one of its writes is rejected by the server
+    FAILURES = {
+        'add_s': "ERROR: Could not create ldap user",
+        'modify_s': "ERROR: Could not update ldap user",
+        'rename_s': "ERROR: Could not rename ldap user",
+        'delete_s': "ERROR: Could not delete ldap user"
+    }
+    
+    def __init__(self, session, window):
+        self.session = session
+        self.window = max(1, window)
+        self.controller = session.controller
+        # msgid -> (row index, accounts, call name, args, start, attempt, 
+        # callbacks)
+        self.inflight = collections.OrderedDict()
+        # row index / username -> number of writes in flight
+        self.rows = collections.Counter()
+        self.accounts = collections.Counter()
+        # row index -> result of its first failed write
+        self.failures = {}
+        self.index = None
+        self.current = set()
+        # Callbacks of the last write of the row, None once it succeeded
+        self.last = None
+    
+    def beginRow(self, index, accounts):
+        """Start a new row, waiting for writes to the same accounts"""
+        
+        while any(self.accounts[a] for a in accounts):
+            self.collect()
+        self.index = index
+        self.current = accounts
+        self.last = None
+    
+    def afterWrite(self, callback):
+        """Run callback once the last write of the row is answered with 
+        success, and never when it fails"""
+        
+        if self.last is None:
+            callback()
+        else:
+            self.last.append(callback)
+    
+    def busy(self, index):
+        """Check if a row still has writes in flight"""
+        
+        return self.rows[index] > 0
+    
+    def finish(self, index, row, result, start):
+        """Replace the result of a row whose writes failed"""
+        
+        return (index, row, self.failures.pop(index, result), 
+                time.time() - start)
+    
+    def submit(self, name, *args):
+        """Send one write and remember which row it belongs to"""
+        
+        # Keep the writes of one row in order and the window bounded
+        while self.rows[self.index] or len(self.inflight) >= self.window:
+            self.collect()
+        
+        self.last = []
+        self.send(self.index, self.current, name, args, 0, self.last)
+        self.rows[self.index] += 1
+        for account in self.current:
+            self.accounts[account] += 1
+    
+    def send(self, index, accounts, name, args, attempt, callbacks):
+        """Put one write on the wire"""
+        
+        # Only wait for a free slot when we have nothing of our own out
+        if self.controller is not None:
+            while not self.controller.acquire(blocking=not self.inflight):
+                self.makeRoom()
+        
+        try:
+            msgid = getattr(self.session, self.ASYNC_CALLS[name])(*args)
+        except ldap.LDAPError as e:
+            if self.controller is not None:
+                self.controller.release(0.0, e)
+            raise
+        self.inflight[msgid] = (index, accounts, name, args, time.time(), 
+                                attempt, callbacks)
+    
+    def settle(self, msgid, error=None, retry=True):
+        """Book the answer to one write, retry sends it again after a 
+        transient error"""
+        
+        index, accounts, name, args, start, attempt, callbacks = \
+            self.inflight.pop(msgid)
+        METRICS.observe('phase', name[:-2], time.time() - start)
+        
+        if self.controller is not None:
+            self.controller.release(time.time() - start, error)
+            
+            # Send a write that hit a transient error again
+            if isinstance(error, RateController.TRANSIENT) and retry and \
+                    attempt < self.controller.retries:
+                logging.warning("ldap {0} failed with {1}, retrying" \
+                                .format(name, error))
+                self.controller.backoff(attempt + 1)
+                try:
+                    self.send(index, accounts, name, args, attempt + 1, 
+                                callbacks)
+                    return
+                except ldap.LDAPError as e:
+                    error = e
+        
+        self.rows[index] -= 1
+        for account in accounts:
+            self.accounts[account] -= 1
+        
+        if error is not None:
+            echo("ERROR: ldap {0} failed for {1}: {2}".format(name, args[0], 
+                                                                error))
+            logging.error("asynchronous ldap {0} failed for: {1}" \
+                            .format(name, args[0]))
+            self.failures.setdefault(index, self.FAILURES[name])
+            return
+        
+        for callback in callbacks:
+            callback()
+        if callbacks is self.last:
+            self.last = None
+    
+    def collect(self):
+        """Wait for the oldest write in flight to be answered"""
+        
+        msgid = next(iter(self.inflight))
+        try:
+            self.session.result3(msgid, all=1, timeout=-1)
+            self.settle(msgid)
+        
+        except ldap.SERVER_DOWN as e:
+            # All outstanding requests died with the connection
+            lost = list(self.inflight)
+            # Without a connection they fail with their rows
+            retry = self.session.rebind()
+            for msgid in lost:
+                self.settle(msgid, e, retry)
+        
+        except ldap.LDAPError as e:
+            self.settle(msgid, e)
+    
+    def drain(self):
+        """Wait for every write in flight"""
+        
+        while self.inflight:
+            self.collect()
+    
+    def makeRoom(self):
+        """Collect one answer, False when there is nothing in flight"""
+        
+        if not self.inflight:
+            return False
+        self.collect()
+        
+        return True
+    
+    def search_s(self, *args, **kwargs):
+        # Reads inside a row must see the writes it already sent
+        while self.rows[self.index]:
+            self.collect()
+        
+        # Reads for a replica do not need a slot at the provider
+        if self.controller is not None and (self.session.replicas is None or
+                not self.session.replicas.routable(args)):
+            if self.session.replicas is not None:
+                METRICS.count('read', ('provider',))
+            with METRICS.timer('search'):
+                return self.session.throttled('search_s', args, kwargs, 
+                                                self.makeRoom)
+        
+        return self.session.search_s(*args, **kwargs)
     
+    def __getattr__(self, name):
+        if name in self.ASYNC_CALLS:
+            return lambda *args: self.submit(name, *args)
+        
+        return getattr(self.session, name)
 
-def ldapConnect():
-    """Function to bind to LDAP server"""
+def berEncode(tag, value):
+    """BER encode a value under a tag, with a definite length"""
+    
+    length = len(value)
+    if length < 0x80:
+        return chr(tag) + chr(length) + value
+    
+    octets = ''
+    while length:
+        octets = chr(length & 0xff) + octets
+        length >>= 8
+    
+    return chr(tag) + chr(0x80 | len(octets)) + octets + value
 
-    ldap_user = USER
-    ldap_secret = PASSWORD
-    ldap_server = LDAPSERVER
+class LDAPTransaction(object):
+    """Writes of a session grouped into RFC 5805 LDAP transactions
     
-    try:
-        # Open a connection to the LDAP server
-        l = ldap.initialize(ldap_server)
-        l.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+    Stands in for the session in the actions. Their writes join the open 
+    transaction, which is committed every size rows, and before a row on 
+    an account the transaction already wrote to, as reads do not see 
+    uncommitted writes. When the server has no transactions or one is 
+    aborted, the writes are made one by one instead and the failures 
+    among them replace the results of their rows."""
+    
+    START_OID = '1.3.6.1.1.21.1'
+    SPEC_OID = '1.3.6.1.1.21.2'
+    END_OID = '1.3.6.1.1.21.3'
+    
+    # Servers and connections without transactions, the latter have no 
+    # extended operations at all
+    UNSUPPORTED = (ldap.PROTOCOL_ERROR, ldap.UNAVAILABLE_CRITICAL_EXTENSION, 
+                    AttributeError)
+    
+    # Call with request controls for every write the actions make
+    TXN_CALLS = {
+        'add_s': 'add_ext_s',
+        'modify_s': 'modify_ext_s',
+        'rename_s': 'rename_s',
+        'delete_s': 'delete_ext_s'
+    }
+    
+    def __init__(self, session, size):
+        self.session = session
+        self.size = size
+        self.txnid = None
+        self.supported = True
+        # (index, name, args, callbacks) of the writes in the open 
+        # transaction
+        self.writes = []
+        self.rows = 0
+        self.accounts = set()
+        self.index = None
+        # index -> result of rows whose writes failed
+        self.failures = {}
+        # Callbacks of the last write of the row, None once it is made
+        self.last = None
+    
+    def beginRow(self, index, accounts):
+        """Start a row, returns whether the open transaction was ended"""
         
-        # Bind with a user that has rights to add/update objects
-        l.simple_bind_s(ldap_user, ldap_secret)
+        ended = False
+        if self.rows >= self.size or self.accounts & accounts:
+            self.commit()
+            ended = True
+        
+        self.index = index
+        self.rows += 1
+        self.accounts |= accounts
+        self.last = None
+        
+        return ended
     
-    except ldap.LDAPError, e:
-        print("ERROR: Could not establish LDAP connection: {0}".format(e))
-        logging.error("problem binding to ldap LDAP server")
-        return False
+    def afterWrite(self, callback):
+        """Run callback once the last write of the row is committed, and 
+        never when it fails"""
         
-    return l
+        if self.last is None:
+            callback()
+        else:
+            self.last.append(callback)
+    
+    def finish(self, index, row, result, start):
+        """Replace the result of a row whose writes failed"""
+        
+        return (index, row, self.failures.pop(index, result), 
+                time.time() - start)
+    
+    def start(self):
+        """Open a transaction, unless the server turned that down before"""
+        
+        try:
+            respoid, self.txnid = self.session.extop_s(
+                                    ExtendedRequest(self.START_OID, None))
+        
+        except self.UNSUPPORTED as e:
+            self.supported = False
+            logging.warning("ldap transactions are not available, writing " \
+                            "one at a time: {0}".format(e))
+        
+        except ldap.LDAPError as e:
+            # The next write tries again
+            logging.warning("unable to start an ldap transaction, writing " \
+                            "without one: {0}".format(e))
+    
+    def end(self, commit=True):
+        """Commit or abort the open transaction"""
+        
+        txnid, self.txnid = self.txnid, None
+        
+        # txnEndReq ::= SEQUENCE { commit BOOLEAN DEFAULT TRUE, 
+        #                          identifier OCTET STRING }
+        value = berEncode(0x04, txnid)
+        if not commit:
+            value = berEncode(0x01, '\x00') + value
+        self.session.extop_s(ExtendedRequest(self.END_OID, 
+                                                berEncode(0x30, value)))
+    
+    def write(self, name, *args):
+        """Add a write to the open transaction"""
+        
+        if self.txnid is None and self.supported:
+            self.start()
+        if self.txnid is None:
+            self.last = None
+            return getattr(self.session, name)(*args)
+        
+        control = RequestControl(self.SPEC_OID, True, self.txnid)
+        try:
+            result = getattr(self.session, self.TXN_CALLS[name])(*args, 
+                                                    serverctrls=[control])
+        
+        except ldap.LDAPError as e:
+            logging.warning("ldap {0} refused in a transaction, writing one " \
+                            "at a time: {1}".format(name, e))
+            try:
+                self.end(commit=False)
+            except ldap.LDAPError:
+                pass
+            self.replay()
+            # The action sees the outcome of its own write as usual
+            self.last = None
+            return getattr(self.session, name)(*args)
+        
+        self.last = []
+        self.writes.append((self.index, name, args, self.last))
+        return result
+    
+    def commit(self):
+        """End the open transaction and start over with an empty one"""
+        
+        if self.txnid is not None:
+            try:
+                self.end()
+                logging.debug("committed a transaction of {0} writes" \
+                                .format(len(self.writes)))
+                for index, name, args, callbacks in self.writes:
+                    for callback in callbacks:
+                        callback()
+            
+            except ldap.LDAPError as e:
+                logging.warning("ldap transaction of {0} writes aborted, " \
+                                "writing them one at a time: {1}" \
+                                .format(len(self.writes), e))
+                self.replay()
+        
+        self.writes = []
+        self.rows = 0
+        self.accounts = set()
+    
+    def replay(self):
+        """Make the writes of an aborted transaction one by one"""
+        
+        writes, self.writes = self.writes, []
+        for index, name, args, callbacks in writes:
+            try:
+                getattr(self.session, name)(*args)
+            
+            except ldap.LDAPError as e:
+                echo("ERROR: ldap {0} failed for {1}: {2}".format(name, 
+                                                            args[0], e))
+                logging.error("ldap {0} failed for: {1}".format(name, args[0]))
+                self.failures.setdefault(index, LDAPPipeline.FAILURES[name])
+                continue
+            
+            for callback in callbacks:
+                callback()
+    
+    def __getattr__(self, name):
+        if name in self.TXN_CALLS:
+            return lambda *args: self.write(name, *args)
+        
+        return getattr(self.session, name)
 
-def findUser(l, username):
-    """Do a quick check if the user already exists"""
+class DirectoryModel(object):
+    """In-memory copy of the directory for --dry-run
+    
+    The users live in a snapshot UidIndex that the actions keep up to 
+    date themselves, as they do with --prefetch. A few other entries, 
+    the uidNumber counter, are kept whole. Writes are counted and, with 
+    --ops, written out as JSON lines."""
+    
+    MODOPS = {
+        ldap.MOD_ADD: 'add',
+        ldap.MOD_DELETE: 'delete',
+        ldap.MOD_REPLACE: 'replace'
+    }
+    
+    def __init__(self, index):
+        self.index = index
+        # lowercase DN -> (DN, attributes) of the entries kept whole
+        self.others = {}
+        self.counts = collections.Counter()
+        self.f_ops = None
+        self.lock = threading.Lock()
+    
+    def keep(self, dn, entry):
+        """Keep an entry that is not a user whole"""
+        
+        self.others[dn.lower()] = (dn, dict((attr, list(values)) 
+                                        for attr, values in entry.items()))
+    
+    def entries(self):
+        """Yield (dn, attrs) of the users of the student, guest and 
+        employee OUs, as directoryEntries() does"""
+        
+        suffixes = tuple(ou.lower() for ou in (STUDENTOU, GUESTOU, EMPOU))
+        for dn, attrs in self.index.dump():
+            if dn.lower().endswith(suffixes):
+                yield dn, attrs
+    
+    def search(self, base, scope, attrlist=None):
+        """Answer a base-scope read"""
+        
+        if scope != ldap.SCOPE_BASE:
+            return []
+        
+        other = self.others.get(base.lower())
+        if other is not None:
+            return [(other[0], dict(other[1]))]
+        
+        # A user, found by the uid of its RDN
+        rdn = base.split(',', 1)[0]
+        if not rdn.lower().startswith('uid='):
+            return []
+        uid = rdn[4:]
+        if base.lower() not in [dn.lower() for dn in self.index.lookup(uid)]:
+            return []
+        attrs = self.index.entry(uid) or {}
+        if self.index.posix(uid):
+            attrs['objectClass'] = ['posixAccount']
+        
+        return [(base, attrs)]
+    
+    def modify(self, dn, mods):
+        """Apply a modify to an entry kept whole, as the server would"""
+        
+        other = self.others.get(dn.lower())
+        if other is None:
+            return
+        
+        attrs = dict((attr, list(values)) for attr, values in other[1].items())
+        for op, attr, values in mods:
+            if values is not None and not isinstance(values, list):
+                values = [values]
+            if op == ldap.MOD_REPLACE:
+                attrs[attr] = list(values or [])
+            elif op == ldap.MOD_ADD:
+                attrs.setdefault(attr, []).extend(values)
+            elif values is None:
+                attrs.pop(attr, None)
+            else:
+                for value in values:
+                    if value not in attrs.get(attr, []):
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such ' \
+                                                        'attribute'})
+                    attrs[attr].remove(value)
+        self.others[dn.lower()] = (other[0], dict((attr, values) for 
+                                    attr, values in attrs.items() if values))
+    
+    def record(self, op, dn, **fields):
+        """Count a write and add it to the operations file"""
+        
+        with self.lock:
+            self.counts[op] += 1
+            if self.f_ops is not None:
+                fields.update(op=op, dn=dn)
+                self.f_ops.write(json.dumps(fields) + "\n")
+    
+    def close(self):
+        """Report what the run would have sent"""
+        
+        summary = ", ".join("{0} {1}".format(self.counts[op], op) for op in 
+                            ('add', 'modify', 'rename', 'delete'))
+        echo("DRY RUN: would send {0}".format(summary))
+        logging.info("dry run would send {0}".format(summary))
+        if self.f_ops is not None:
+            self.f_ops.close()
+            self.f_ops = None
 
-    # Set the basic search parameters
-    searchScope = ldap.SCOPE_SUBTREE
-    retrieveAttributes = ['dn']
-    searchFilter = "uid={}".format(username)
+class DryRunSession(object):
+    """Stands in for an LDAPSession with --dry-run
+    
+    Reads are answered from the DirectoryModel and writes are recorded 
+    there instead of being sent."""
+    
+    controller = None
+    replicas = None
+    
+    def __init__(self, model):
+        self.model = model
+    
+    def connect(self):
+        return True
+    
+    def rebind(self):
+        return True
+    
+    def unbind(self):
+        pass
+    
+    def provider(self, name, *args, **kwargs):
+        return getattr(self, name)(*args, **kwargs)
+    
+    def afterWrite(self, callback):
+        callback()
+    
+    def search_s(self, base, scope, filterstr='(objectClass=*)', 
+                    attrlist=None):
+        return self.model.search(base, scope, attrlist)
+    
+    def add_s(self, dn, modlist):
+        self.model.record('add', dn, attrs=dict((attr, values if 
+                            isinstance(values, list) else [values]) 
+                            for attr, values in modlist))
+    
+    def modify_s(self, dn, modlist):
+        self.model.modify(dn, modlist)
+        self.model.record('modify', dn, mods=[[DirectoryModel.MODOPS[op], 
+                            attr, values if isinstance(values, list) or 
+                            values is None else [values]] 
+                            for op, attr, values in modlist])
+    
+    def rename_s(self, dn, newrdn):
+        self.model.record('rename', dn, newrdn=newrdn)
+    
+    def delete_s(self, dn):
+        self.model.record('delete', dn)
+
+class UidIndex(object):
+    """Compact in-memory index of the uids in the directory
+    
+    Every uid owns a slot number; the DN and the flags of a slot live in
+    plain arrays next to each other rather than in a dict per entry.
+    The index is kept up to date by the actions as they go."""
+    
+    __slots__ = ('slots', 'dns', 'flags', 'entries', 'free', 'lock')
+    
+    POSIX = 1
+    
+    def __init__(self, snapshot=False):
+        # lowercase uid -> slot number
+        self.slots = {}
+        # slot number -> DN, or a tuple of DNs for duplicate uids
+        self.dns = []
+        self.flags = bytearray()
+        # slot number -> values of USERATTRS, only kept for a snapshot
+        self.entries = [] if snapshot else None
+        self.free = []
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def add(self, uid, dn, posix=False):
+        """Record an entry for uid"""
         
-    try:
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, 
-                                    retrieveAttributes)		
+        key = uid.lower()
+        flag = self.POSIX if posix else 0
+        
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                # Same uid in several places, keep all DNs
+                old = self.dns[slot]
+                old = old if isinstance(old, tuple) else (old,)
+                self.dns[slot] = old + (dn,)
+                self.flags[slot] |= flag
+                # No single entry to compare against any more
+                if self.entries is not None:
+                    self.entries[slot] = None
+                return
+            
+            if self.free:
+                slot = self.free.pop()
+                self.dns[slot] = dn
+                self.flags[slot] = flag
+            else:
+                slot = len(self.dns)
+                self.dns.append(dn)
+                self.flags.append(flag)
+                if self.entries is not None:
+                    self.entries.append(None)
+            self.slots[key] = slot
     
-    except ldap.LDAPError, e:
-        print("ERROR: problems with LDAP search: {0}".format(e))
-        logging.error("problem with LDAP search for: {0}".format(username))
+    def remove(self, uid):
+        """Forget uid, its slot is reused by the next add"""
+        
+        with self.lock:
+            slot = self.slots.pop(uid.lower(), None)
+            if slot is not None:
+                self.dns[slot] = None
+                self.flags[slot] = 0
+                if self.entries is not None:
+                    self.entries[slot] = None
+                self.free.append(slot)
     
-    # Check the search results
-    if len(ldap_result) == 0:
-        logging.info("user {0} does not exist in ldap".format(username))
-        return False
+    def rename(self, uid, newuid, newdn):
+        """Move the entry of uid to newuid, keeping its flags"""
         
-    if len(ldap_result) > 1:
-        logging.info("user {0} has multiple entries in ldap".format(username))
-        return False
+        with self.lock:
+            slot = self.slots.pop(uid.lower(), None)
+            if slot is None:
+                return
+            self.slots[newuid.lower()] = slot
+            self.dns[slot] = newdn
+    
+    def lookup(self, uid, posix=False):
+        """Return the DNs for uid like a search for it would"""
         
-    return True
+        slot = self.slots.get(uid.lower())
+        if slot is None or (posix and not self.flags[slot] & self.POSIX):
+            return []
+        
+        dns = self.dns[slot]
+        
+        return list(dns) if isinstance(dns, tuple) else [dns]
     
-def containsPosixAccount(l, username):
-    """Check for presence of objectClass=posixAccount"""
+    def store(self, uid, attrs):
+        """Keep the USERATTRS values of uid in the snapshot"""
+        
+        slot = self.slots.get(uid.lower())
+        if self.entries is None or slot is None \
+                or isinstance(self.dns[slot], tuple):
+            return
+        
+        attrs = caseless(attrs)
+        values = []
+        for attr in USERATTRS:
+            value = attrs.get(attr.lower())
+            if value is None:
+                values.append(None)
+            else:
+                values.append(tuple(value) if isinstance(value, list) 
+                                else (value,))
+        self.entries[slot] = tuple(values)
+    
+    def entry(self, uid):
+        """Return the snapshot of uid as an attribute dict, or None"""
+        
+        slot = self.slots.get(uid.lower())
+        if self.entries is None or slot is None \
+                or self.entries[slot] is None:
+            return None
+        
+        return dict((attr, list(value)) for attr, value 
+                    in zip(USERATTRS, self.entries[slot]) if value is not None)
+    
+    def posix(self, uid):
+        """Check the posix flag of uid"""
+        
+        slot = self.slots.get(uid.lower())
+        
+        return slot is not None and bool(self.flags[slot] & self.POSIX)
+    
+    def dump(self):
+        """Yield (dn, attrs) of every entry like a search for them would"""
+        
+        for uid, slot in self.slots.items():
+            dns = self.dns[slot]
+            objectClass = ['posixAccount'] if self.flags[slot] else []
+            if isinstance(dns, tuple):
+                for dn in dns:
+                    yield dn, {'uid': [uid], 'objectClass': objectClass}
+                continue
+            attrs = self.entry(uid) or {'uid': [uid]}
+            attrs['objectClass'] = objectClass
+            yield dns, attrs
 
-    # Set the basic search parameters
-    searchScope = ldap.SCOPE_SUBTREE
-    retrieveAttributes = None
-    searchFilter = "(&(uid={})(objectClass=posixAccount))".format(username)
+def pagedSearch(l, base, searchFilter, attrs, pagesize=1000):
+    """Generator with the results of a paged (RFC 2696) subtree search"""
+    
+    control = SimplePagedResultsControl(True, size=pagesize, cookie='')
+    
+    while True:
+        msgid = l.search_ext(base, ldap.SCOPE_SUBTREE, searchFilter, attrs, 
+                                serverctrls=[control])
+        rtype, rdata, rmsgid, serverctrls = l.result3(msgid)
+        
+        for dn, entry in rdata:
+            # Skip search continuation references
+            if dn is not None:
+                yield dn, entry
+        
+        # The server hands back a cookie until the last page
+        cookie = ''
+        for ctrl in serverctrls:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                cookie = ctrl.cookie
+        if not cookie:
+            break
+        control.cookie = cookie
 
+def buildUidIndex(l, pagesize=1000, snapshot=False):
+    """Load every uid under baseDN into a UidIndex
+    
+    With snapshot the attributes update() manages are kept as well."""
+    
+    index = UidIndex(snapshot)
+    attrs = ['uid', 'objectClass']
+    if snapshot:
+        attrs.extend(USERATTRS)
+    
     try:
-        ldap_result = l.search_s(baseDN, searchScope, searchFilter, 
-                                    retrieveAttributes)
+        for dn, entry in pagedSearch(l, baseDN, "(uid=*)", attrs, pagesize):
+            entry = caseless(entry)
+            posix = 'posixaccount' in [oc.lower() for oc in 
+                                        entry.get('objectclass', [])]
+            for uid in entry.get('uid', []):
+                index.add(uid, dn, posix)
+                index.store(uid, entry)
+    
+    except ldap.LDAPError as e:
+        echo("ERROR: unable to prefetch uids, searching per user: " \
+                "{0}".format(e))
+        logging.error("uid prefetch failed, falling back to searches")
+        return None
+    
+    logging.info("prefetched {0} uids from ldap".format(len(index)))
+    
+    return index
 
-    except ldap.LDAPError, e:
-        print("ERROR: problems with LDAP search: {0}".format(e))
-        logging.error("problem with LDAP search for: {0}".format(username))
+def loadModel(l, pagesize=1000):
+    """Read the users and the IDCOUNTER entry into a DirectoryModel"""
+    
+    index = buildUidIndex(l, pagesize, snapshot=True)
+    if index is None:
+        return None
+    
+    model = DirectoryModel(index)
+    if IDCOUNTER:
+        try:
+            for dn, entry in l.search_s(IDCOUNTER, ldap.SCOPE_BASE):
+                model.keep(dn, entry)
+        except ldap.LDAPError as e:
+            logging.warning("unable to read the uidNumber counter {0}: {1}" \
+                            .format(IDCOUNTER, e))
+    
+    return model
+
+class ModelReader(ldif.LDIFParser):
+    """Read the users and the IDCOUNTER entry of an LDIF file into a model"""
+    
+    def __init__(self, f_ldif):
+        ldif.LDIFParser.__init__(self, f_ldif)
+        self.model = DirectoryModel(UidIndex(snapshot=True))
+        self.suffix = ',' + baseDN.lower()
+    
+    def handle(self, dn, entry):
+        if IDCOUNTER and dn.lower() == IDCOUNTER.lower():
+            self.model.keep(dn, entry)
+            return
+        
+        # Users as the (uid=*) search under baseDN finds them
+        if not dn.lower().endswith(self.suffix):
+            return
+        entry = caseless(entry)
+        posix = 'posixaccount' in [oc.lower() for oc in 
+                                    entry.get('objectclass', [])]
+        for uid in entry.get('uid', []):
+            self.model.index.add(uid, dn, posix)
+            self.model.index.store(uid, entry)
+
+def readModel(path):
+    """Load a DirectoryModel from an LDIF file"""
+    
+    try:
+        with open(path, 'rb') as f_ldif:
+            reader = ModelReader(f_ldif)
+            reader.parse()
+    except (IOError, ValueError) as e:
+        echo("ERROR: unable to read the snapshot {0}: {1}".format(path, e))
+        logging.error("unable to read the snapshot: {0}".format(path))
+        return None
+    
+    logging.info("read {0} uids from {1}".format(len(reader.model.index), 
+                                                    path))
+    
+    return reader.model
+
+def caseless(attrs):
+    """Key an attribute dict by lowercase attribute names"""
+    
+    return dict((attr.lower(), value) for attr, value in attrs.items())
 
+def entryAttrs(entry):
+    """Split an entry into the USERATTRS and whether it is a posixAccount"""
+    
+    entry = caseless(entry)
+    posix = 'posixaccount' in [oc.lower() for oc in 
+                                entry.get('objectclass', [])]
+    
+    # Only hand back what update() manages, under its own spelling
+    attrs = dict((attr, entry[attr.lower()]) for attr in USERATTRS 
+                    if attr.lower() in entry)
+    
+    return attrs, posix
+
+@timed('lookupUser')
+def lookupUser(l, username, read=False):
+    """Read a user: whether it exists, its USERATTRS and whether it is a 
+    posixAccount
+    
+    Reads the entry at the DN buildDN() computes with a base-scope search 
+    and only searches the whole tree by uid when that misses. Returns a 
+    tuple (attrs, posix), attrs is None when the user does not exist. 
+    With a prefetched index the attributes come from its snapshot; when 
+    it has none they are {}, or read from the entry if read is set."""
+    
+    if UIDINDEX is not None:
+        if len(UIDINDEX.lookup(username)) != 1:
+            logging.debug("user {0} does not exist in ldap".format(username))
+            return None, False
+        attrs = UIDINDEX.entry(username)
+        if attrs is not None or not read:
+            return attrs or {}, \
+                    len(UIDINDEX.lookup(username, posix=True)) == 1
+    
+    # Set the basic search parameters
+    retrieveAttributes = list(USERATTRS) + ['objectClass']
+    
+    try:
+        try:
+            ldap_result = l.search_s(buildDN(username), ldap.SCOPE_BASE, 
+                                        "(objectClass=*)", retrieveAttributes)
+        except ldap.NO_SUCH_OBJECT:
+            ldap_result = []
+        
+        if not ldap_result:
+            searchFilter = "uid={}".format(username)
+            ldap_result = l.search_s(baseDN, ldap.SCOPE_SUBTREE, searchFilter, 
+                                        retrieveAttributes)
+    
+    except ldap.LDAPError as e:
+        echo("ERROR: problems with LDAP search: {0}".format(e))
+        logging.error("problem with LDAP search for: {0}".format(username))
+        return None, False
+    
     # Check the search results
     if len(ldap_result) == 0:
-        logging.info("user {0} does not exist in ldap".format(username))
-        return False
-
+        logging.debug("user {0} does not exist in ldap".format(username))
+        return None, False
+        
     if len(ldap_result) > 1:
         logging.info("user {0} has multiple entries in ldap".format(username))
-        return False
+        return None, False
+    
+    return entryAttrs(ldap_result[0][1])
 
-    return True
+def findUser(l, username):
+    """Do a quick check if the user already exists"""
+    
+    return lookupUser(l, username)[0] is not None
 
+@memoized
 def buildDN(username):
     """Function to construct FQN for a username"""
 
@@ -568,13 +4350,13 @@ def buildDN(username):
     
     if userType == "STU":
         dn = "uid=" + username + STUDENTOU
-        logging.info("looks like we have a student here: {0}".format(username))
+        logging.debug("looks like we have a student here: {0}".format(username))
     elif userType == "GST":
         dn = "uid=" + username + GUESTOU
-        logging.info("looks like we have a guest here: {0}".format(username))
+        logging.debug("looks like we have a guest here: {0}".format(username))
     else:
         dn="uid=" + username + EMPOU
-        logging.info("looks like we have an employee here: {0}".format(username))
+        logging.debug("looks like we have an employee here: {0}".format(username))
 
     return dn
 
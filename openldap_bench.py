@@ -0,0 +1,678 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for openldap.py against an in-process stand-in for the
+ldap server.
+
+Usage:
+    python openldap_bench.py --rows 10000 --latency 2 -- -p 8 -w 4
+
+Options:
+    -h --help
+    -n --rows	Number of synthetic user actions (default: 10000)
+    -m --mix	Share of each action type (default:
+                create=30,update=40,rename=10,delete=20)
+    -l --latency	Injected latency per round trip in ms (default: 0)
+    --preload	Users in the directory before the run (default: 1000)
+    --seed	Random seed for the generated batch (default: 1)
+    --json	Print the report as JSON
+
+Everything after -- is handed to openldap.py, e.g. -- -p 8 to
+compare execution modes.
+
+The batch is generated so that every action is valid when its turn
+comes, with student, guest and employee usernames built from
+STUPATTERN and GSTPATTERN. It then runs through the real main() of
+openldap.py, with ldap.initialize() returning FakeLDAPObject, which
+keeps the directory in memory and sleeps the injected latency for
+every round trip. Writes in an RFC 5805 transaction (-- -t N) are
+held and made when it is committed.
+
+Output:
+
+ops/sec, p50/p99 latency of every action type and round trips per
+row. Latency is the time spent in create()/update()/delete(); with
+--pipeline the writes are answered after that.
+"""
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import random
+import base64
+import shutil
+import tempfile
+import argparse
+import threading
+import collections
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+import openldap_settings
+
+# RFC 5805 transaction OIDs, see LDAPTransaction in openldap.py
+TXN_START = '1.3.6.1.1.21.1'
+TXN_SPEC = '1.3.6.1.1.21.2'
+TXN_END = '1.3.6.1.1.21.3'
+
+# Settings the synthetic batch is built for, see openldap_settings.py
+SETTINGS = {
+    'LDAPSERVER': 'ldap://bench.invalid/',
+    'USER': 'cn=admin,dc=bench,dc=example',
+    'PASSWORD': base64.b64encode('bench'),
+    'BASEDN': 'dc=bench,dc=example',
+    'MAILDOMAIN': '@bench.example',
+    'STUPATTERN': '_',
+    'GSTPATTERN': 'gst',
+    'STUDENTOU': ',ou=students,dc=bench,dc=example',
+    'GUESTOU': ',ou=guests,dc=bench,dc=example',
+    'EMPOU': ',ou=people,dc=bench,dc=example'
+}
+
+def main(argv):
+    """This is the main body of the benchmark"""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--rows", "-n", type=int, default=10000,
+                        help="Number of synthetic user actions")
+    parser.add_argument("--mix", "-m", type=str,
+                        default="create=30,update=40,rename=10,delete=20",
+                        help="Share of each action type")
+    parser.add_argument("--latency", "-l", type=float, default=0,
+                        help="Injected latency per round trip in ms")
+    parser.add_argument("--preload", type=int, default=1000,
+                        help="Users in the directory before the run")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed for the generated batch")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="Arguments for openldap.py after --")
+
+    args = parser.parse_args(argv[1:])
+
+    mix = dict((name, float(share)) for name, share in
+                (item.split('=') for item in args.mix.split(',')))
+    extra = args.args[1:] if args.args[:1] == ['--'] else args.args
+
+    report = run(args.rows, mix, args.latency / 1000.0, args.preload,
+                    args.seed, extra)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        printReport(report)
+
+def run(rows, mix, latency, preload, seed, extra):
+    """Generate a batch, run it through openldap.main() and measure it"""
+
+    # The script reads its settings through readConfig()
+    for name, value in SETTINGS.items():
+        setattr(openldap_settings, name, value)
+
+    import openldap
+
+    workdir = tempfile.mkdtemp(prefix='openldap_bench')
+    in_file = os.path.join(workdir, 'input.json')
+    out_file = os.path.join(workdir, 'output.csv')
+
+    directory = FakeDirectory(latency)
+    for username in generate(in_file, rows, mix, preload, seed):
+        directory.preload(username)
+
+    timings = collections.defaultdict(list)
+    originals = {}
+
+    def timed(name, function):
+        """Wrap an action to record how long it takes"""
+
+        def action(l, username, *args):
+            kind = name
+            if name == 'update' and username != args[0]:
+                kind = 'rename'
+            start = time.time()
+            try:
+                return function(l, username, *args)
+            finally:
+                timings[kind].append(time.time() - start)
+
+        return action
+
+    for name in ('create', 'update', 'delete'):
+        originals[name] = getattr(openldap, name)
+        setattr(openldap, name, timed(name, originals[name]))
+    initialize = ldap.initialize
+    ldap.initialize = directory.connect
+
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    os.chdir(workdir)
+    try:
+        # Keep the per-row messages of the script out of the report
+        sys.stdout = open(os.devnull, 'w')
+        sys.argv = ['openldap.py', '-f', in_file, '-o', out_file] + extra
+        start = time.time()
+        openldap.main(sys.argv)
+        elapsed = time.time() - start
+
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        ldap.initialize = initialize
+        for name, function in originals.items():
+            setattr(openldap, name, function)
+
+    results = collections.Counter()
+    with open(out_file, 'rb') as f_out:
+        for line in f_out.readlines()[1:]:
+            results[line.rstrip('\r\n').split(',', 2)[2].split(':')[0]] += 1
+    shutil.rmtree(workdir)
+
+    report = {
+        'rows': rows,
+        'args': ' '.join(extra),
+        'latency_ms': latency * 1000,
+        'seconds': round(elapsed, 3),
+        'ops_per_sec': round(rows / elapsed, 1) if elapsed else None,
+        'round_trips': directory.roundtrips,
+        'round_trips_per_row': round(float(directory.roundtrips) / rows, 2),
+        'results': dict(results),
+        'actions': {}
+    }
+    for kind, values in sorted(timings.items()):
+        values.sort()
+        report['actions'][kind] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3)
+        }
+
+    return report
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def printReport(report):
+    """Print the report as a small table"""
+
+    print("rows: {0}  args: {1}  latency: {2} ms".format(
+            report['rows'], report['args'] or '(none)', report['latency_ms']))
+    print("elapsed: {0} s  ops/sec: {1}".format(report['seconds'],
+                                                report['ops_per_sec']))
+    print("round trips: {0}  per row: {1}".format(
+            report['round_trips'], report['round_trips_per_row']))
+    print("results: {0}".format(", ".join("{0}={1}".format(k, v)
+            for k, v in sorted(report['results'].items()))))
+    print("{0:<8} {1:>8} {2:>10} {3:>10}".format('action', 'count',
+                                                    'p50 ms', 'p99 ms'))
+    for kind, stats in sorted(report['actions'].items()):
+        print("{0:<8} {1:>8} {2:>10} {3:>10}".format(kind, stats['count'],
+                                    stats['p50_ms'], stats['p99_ms']))
+
+def username(kind, number):
+    """Build a username of the given type as getUserType() sees it"""
+
+    if kind == 'STU':
+        return "stu{0}{1}{2:02d}".format(number, SETTINGS['STUPATTERN'],
+                                            number % 100)
+    if kind == 'GST':
+        return "{0}{1:04d}".format(SETTINGS['GSTPATTERN'], number % 10000)
+
+    return "emp{0}".format(number)
+
+def generate(path, rows, mix, preload, seed):
+    """Write a batch of valid user actions, return the preloaded users"""
+
+    rnd = random.Random(seed)
+    kinds = ['STU', 'STU', 'EMP', 'EMP', 'GST']
+    numbers = iter(xrange(1, sys.maxint))
+
+    def fresh(kind):
+        """A username of kind that was never used before"""
+
+        name = username(kind, next(numbers))
+        while name in used:
+            name = username(kind, next(numbers))
+        used.add(name)
+        return name
+
+    used = set()
+    live = [fresh(rnd.choice(kinds)) for _ in range(preload)]
+    preloaded = list(live)
+
+    actions = sorted(mix)
+    weights = [mix[action] for action in actions]
+
+    with open(path, 'wb') as f_in:
+        f_in.write('{"useractions": [\n')
+        for number in range(rows):
+            action = weighted(rnd, actions, weights)
+            if action != 'create' and not live:
+                action = 'create'
+
+            if action == 'create':
+                name = newname = fresh(rnd.choice(kinds))
+                live.append(name)
+            else:
+                slot = rnd.randrange(len(live))
+                name = newname = live[slot]
+                if action == 'rename':
+                    newname = fresh(openldapType(name))
+                    live[slot] = newname
+                elif action == 'delete':
+                    live[slot] = live[-1]
+                    live.pop()
+
+            row = {
+                "action": 'update' if action == 'rename' else action,
+                "username": name,
+                "newusername": newname,
+                "loginDisabled": "False",
+                "uidNumber": 10000 + number,
+                "gidNumber": 10000 + number,
+                "givenName": rnd.choice(['John', 'Jane', 'Alex']),
+                "fullName": "Bench User {0}".format(number),
+                "sn": "User",
+                "employeeType": rnd.choice(['ADM', 'FAC', 'STU']),
+                "DNumber": "D{0:08d}".format(number),
+                "primO": rnd.choice(['Biology', 'Physics', 'History']),
+                "businessCategory": "Aruba-User-Role = \"staff\"",
+                "userPassword": "initial password",
+                "description": "benchmark"
+            }
+            f_in.write((",\n" if number else "") + json.dumps(row))
+        f_in.write('\n]}\n')
+
+    return preloaded
+
+def openldapType(name):
+    """Same classification as getUserType() with the bench settings"""
+
+    if SETTINGS['STUPATTERN'] in name:
+        return 'STU'
+    if SETTINGS['GSTPATTERN'] == name[0:-4]:
+        return 'GST'
+
+    return 'EMP'
+
+def weighted(rnd, items, weights):
+    """Pick one of items with the given weights"""
+
+    point = rnd.uniform(0, sum(weights))
+    for item, weight in zip(items, weights):
+        point -= weight
+        if point <= 0:
+            return item
+
+    return items[-1]
+
+class FakeDirectory(object):
+    """In-memory directory shared by all FakeLDAPObject connections"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        # lowercase DN -> (DN, attributes)
+        self.entries = {}
+        # lowercase uid -> lowercase DN
+        self.uids = {}
+        self.roundtrips = 0
+        self.lock = threading.Lock()
+
+    def connect(self, uri):
+        """Stand-in for ldap.initialize()"""
+
+        return FakeLDAPObject(self)
+
+    def preload(self, name):
+        """Put a user in place before the run"""
+
+        kind = openldapType(name)
+        ou = {'STU': 'STUDENTOU', 'GST': 'GUESTOU'}.get(kind, 'EMPOU')
+        dn = "uid=" + name + SETTINGS[ou]
+        self.store(dn, {
+            'objectClass': ['top', 'person', 'organizationalPerson',
+                            'inetOrgPerson'],
+            'uid': [name], 'cn': [name], 'sn': ['User']
+        })
+
+    def store(self, dn, attrs):
+        key = dn.lower()
+        self.entries[key] = (dn, attrs)
+        for uid in attrs.get('uid', []):
+            self.uids[uid.lower()] = key
+
+    def drop(self, dn):
+        dn, attrs = self.entries.pop(dn.lower())
+        for uid in attrs.get('uid', []):
+            self.uids.pop(uid.lower(), None)
+        return attrs
+
+    def roundtrip(self):
+        """Count a request and wait the injected latency"""
+
+        with self.lock:
+            self.roundtrips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+class FakeLDAPObject(object):
+    """The part of python-ldap's LDAPObject that openldap.py uses
+
+    Requests are applied to the shared FakeDirectory right away;
+    asynchronous ones are answered by result3() once the injected
+    latency has passed since they were sent."""
+
+    def __init__(self, directory):
+        self.dir = directory
+        self.msgid = 0
+        # msgid -> (time of the answer, result type, data, controls, error)
+        self.answers = {}
+        # transaction identifier -> [(function, args)] of its writes
+        self.txns = {}
+        self.txnid = 0
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who, cred):
+        self.dir.roundtrip()
+
+    def unbind_s(self):
+        pass
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                    attrlist=None, attrsonly=0):
+        self.dir.roundtrip()
+        return self.search(base, scope, filterstr, attrlist)
+
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)',
+                        attrlist=None, attrsonly=0, serverctrls=None,
+                        clientctrls=None, timeout=-1, sizelimit=0):
+        self.dir.roundtrip()
+        return self.search(base, scope, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                    attrlist=None, attrsonly=0, serverctrls=None,
+                    clientctrls=None, timeout=-1, sizelimit=0):
+        controls = []
+        # Paged searches get everything in a single page
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                controls.append(SimplePagedResultsControl(True, size=0,
+                                                            cookie=''))
+        return self.later(ldap.RES_SEARCH_RESULT, self.search,
+                            (base, scope, filterstr, attrlist), controls)
+
+    def search(self, base, scope, filterstr, attrlist):
+        """Evaluate a search against the directory"""
+
+        with self.dir.lock:
+            terms = re.findall(r'\(?([A-Za-z]+)=([^()&|]*)\)?', filterstr)
+            base = base.lower()
+
+            # Use the uid index when the filter names a uid
+            uids = [value.lower() for attr, value in terms
+                    if attr.lower() == 'uid' and value != '*']
+            if scope == ldap.SCOPE_BASE:
+                keys = [base] if base in self.dir.entries else None
+            elif uids:
+                keys = [self.dir.uids[uid] for uid in uids[:1]
+                        if uid in self.dir.uids]
+            else:
+                keys = list(self.dir.entries)
+
+            if keys is None:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+
+            found = []
+            for key in keys:
+                if key != base and not key.endswith(',' + base):
+                    continue
+                dn, attrs = self.dir.entries[key]
+                if all(matches(attrs, attr, value) for attr, value in terms):
+                    found.append((dn, select(attrs, attrlist)))
+
+        return found
+
+    def add_s(self, dn, modlist, serverctrls=None, clientctrls=None):
+        self.dir.roundtrip()
+        return self.apply(serverctrls, self.add, (dn, modlist))
+
+    add_ext_s = add_s
+
+    def add(self, dn, modlist):
+        with self.dir.lock:
+            if dn.lower() in self.dir.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            self.dir.store(dn, dict((attr, values(value))
+                                    for attr, value in modlist))
+
+    def modify_s(self, dn, modlist, serverctrls=None, clientctrls=None):
+        self.dir.roundtrip()
+        return self.apply(serverctrls, self.modify, (dn, modlist))
+
+    modify_ext_s = modify_s
+
+    def modify(self, dn, modlist):
+        with self.dir.lock:
+            if dn.lower() not in self.dir.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            attrs = self.dir.drop(dn)
+            for op, attr, value in modlist:
+                old = [name for name in attrs if name.lower() == attr.lower()]
+                current = attrs.pop(old[0]) if old else []
+                if op == ldap.MOD_ADD:
+                    current = current + values(value)
+                elif op == ldap.MOD_DELETE:
+                    current = [v for v in current if value is not None
+                                and v not in values(value)]
+                else:
+                    current = values(value)
+                if current:
+                    attrs[attr] = current
+            self.dir.store(dn, attrs)
+
+    def rename_s(self, dn, newrdn, newsuperior=None, delold=1,
+                    serverctrls=None, clientctrls=None):
+        self.dir.roundtrip()
+        return self.apply(serverctrls, self.rename_entry, (dn, newrdn))
+
+    def rename_entry(self, dn, newrdn):
+        with self.dir.lock:
+            if dn.lower() not in self.dir.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            newdn = newrdn + ',' + dn.split(',', 1)[1]
+            if newdn.lower() in self.dir.entries:
+                raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+            attrs = self.dir.drop(dn)
+            attr, value = newrdn.split('=', 1)
+            attrs[attr] = [value]
+            self.dir.store(newdn, attrs)
+
+    def delete_s(self, dn, serverctrls=None, clientctrls=None):
+        self.dir.roundtrip()
+        return self.apply(serverctrls, self.delete, (dn,))
+
+    delete_ext_s = delete_s
+
+    def delete(self, dn):
+        with self.dir.lock:
+            if dn.lower() not in self.dir.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            self.dir.drop(dn)
+
+    def apply(self, serverctrls, function, args):
+        """Make a write now or hold it for the transaction it names"""
+
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == TXN_SPEC:
+                if ctrl.encodedControlValue not in self.txns:
+                    raise ldap.PROTOCOL_ERROR({'desc': 'Unknown transaction'})
+                self.txns[ctrl.encodedControlValue].append((function, args))
+                return None
+
+        return function(*args)
+
+    def extop_s(self, extreq, serverctrls=None, clientctrls=None,
+                extop_resp_class=None):
+        """RFC 5805 start and end of a transaction"""
+
+        self.dir.roundtrip()
+
+        if extreq.requestName == TXN_START:
+            self.txnid += 1
+            txnid = str(self.txnid)
+            self.txns[txnid] = []
+            return TXN_START, txnid
+
+        if extreq.requestName != TXN_END:
+            raise ldap.PROTOCOL_ERROR({'desc': 'Unsupported extended '
+                                        'operation'})
+
+        # txnEndReq ::= SEQUENCE { commit BOOLEAN DEFAULT TRUE,
+        #                          identifier OCTET STRING }
+        commit, txnid = True, None
+        for tag, value in berFields(berFields(extreq.requestValue)[0][1]):
+            if tag == 0x01:
+                commit = value != '\x00'
+            elif tag == 0x04:
+                txnid = value
+        if txnid not in self.txns:
+            raise ldap.PROTOCOL_ERROR({'desc': 'Unknown transaction'})
+
+        writes = self.txns.pop(txnid)
+        if commit:
+            self.commit(writes)
+
+        return TXN_END, None
+
+    def commit(self, writes):
+        """Make the writes of a transaction, all of them or none"""
+
+        # (lowercase DN, entry before the write or None) in write order
+        undo = []
+        try:
+            for function, args in writes:
+                keys = [args[0].lower()]
+                if function == self.rename_entry:
+                    keys.append((args[1] + ',' +
+                                    args[0].split(',', 1)[1]).lower())
+                with self.dir.lock:
+                    for key in keys:
+                        entry = self.dir.entries.get(key)
+                        undo.append((key, entry and (entry[0],
+                                                        dict(entry[1]))))
+                function(*args)
+
+        except ldap.LDAPError:
+            with self.dir.lock:
+                for key, entry in reversed(undo):
+                    if key in self.dir.entries:
+                        self.dir.drop(key)
+                    if entry is not None:
+                        self.dir.store(*entry)
+            raise
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self.later(ldap.RES_ADD, self.add, (dn, modlist))
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self.later(ldap.RES_MODIFY, self.modify, (dn, modlist))
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1,
+                serverctrls=None, clientctrls=None):
+        return self.later(ldap.RES_MODRDN, self.rename_entry, (dn, newrdn))
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        return self.later(ldap.RES_DELETE, self.delete, (dn,))
+
+    def later(self, rtype, function, args, controls=None):
+        """Run an asynchronous request, answer it after the latency"""
+
+        with self.dir.lock:
+            self.dir.roundtrips += 1
+        self.msgid += 1
+
+        try:
+            data, error = function(*args) or [], None
+        except ldap.LDAPError as e:
+            data, error = None, e
+
+        self.answers[self.msgid] = (time.time() + self.dir.latency, rtype,
+                                    data, controls or [], error)
+
+        return self.msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        if msgid == ldap.RES_ANY:
+            msgid = min(self.answers)
+        ready, rtype, data, controls, error = self.answers.pop(msgid)
+
+        wait = ready - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        if error is not None:
+            raise error
+
+        return rtype, data, msgid, controls
+
+def berFields(data):
+    """Split BER encoded data into a list of (tag, value)"""
+
+    fields = []
+    pos = 0
+    while pos < len(data):
+        tag, length = ord(data[pos]), ord(data[pos + 1])
+        pos += 2
+        if length & 0x80:
+            octets = length & 0x7f
+            length = 0
+            for octet in data[pos:pos + octets]:
+                length = (length << 8) | ord(octet)
+            pos += octets
+        fields.append((tag, data[pos:pos + length]))
+        pos += length
+
+    return fields
+
+def values(value):
+    """Attribute values as a list"""
+
+    if value is None:
+        return []
+
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+def matches(attrs, attr, value):
+    """Check one attr=value term of a filter against an entry"""
+
+    found = [v.lower() for name, vs in attrs.items()
+                if name.lower() == attr.lower() for v in vs]
+    if value == '*':
+        return bool(found)
+
+    return value.lower() in found
+
+def select(attrs, attrlist):
+    """Return the requested attributes of an entry"""
+
+    if attrlist is None:
+        return dict((name, list(vs)) for name, vs in attrs.items())
+
+    wanted = [name.lower() for name in attrlist]
+
+    return dict((name, list(vs)) for name, vs in attrs.items()
+                if name.lower() in wanted)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -6,6 +6,8 @@ IMPORTANT: refer to the code on how they are used.
 
 # LDAP server address to connect to, e.g. ldaps://server.domain.edu:636/
 LDAPSERVER = ''
+# Read replicas for searches, e.g. ['ldaps://replica1.domain.edu:636/']
+LDAPREPLICAS = []
 # User to bind with, e.g. cn=admin,dc=university,dc=edu
 USER = ''
 # Credentials for the above user in base64, e.g. bmljZSB0cnkK
@@ -24,3 +26,18 @@ STUDENTOU = ''
 GUESTOU = ''
 # OU where employees are created, e.g. ,ou=people,dc=university,dc=edu
 EMPOU = ''
+# Entry whose uidNumber is the next free one for new posixAccounts,
+# e.g. cn=uidNext,dc=university,dc=edu
+IDCOUNTER = ''
+# userPassword scheme of new users: SHA, SSHA or PBKDF2-SHA256
+PASSWORDSCHEME = 'SSHA'
+# Iterations of PBKDF2-SHA256, e.g. 100000
+PASSWORDITERATIONS = 100000
+# SMTP server for --notify, e.g. smtp.university.edu
+SMTPSERVER = ''
+# Port of the SMTP server, e.g. 25
+SMTPPORT = 25
+# Seconds to wait for the SMTP server before a notification is retried
+SMTPTIMEOUT = 30
+# Sender of the notifications, e.g. helpdesk@university.edu
+MAILFROM = ''
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+
+"""
+Tests of openldap.py against the in-memory stand-in for the ldap
+server from openldap_bench.py.
+
+Usage:
+    python -m unittest test_openldap
+"""
+
+import os
+import sys
+import csv
+import json
+import shutil
+import StringIO
+import tempfile
+import unittest
+import ldap
+
+import openldap_settings
+import openldap_bench
+import openldap
+
+def user(action, username, number, newusername=None):
+    """A complete input row for username"""
+
+    return {
+        "action": action,
+        "username": username,
+        "newusername": newusername or username,
+        "loginDisabled": "False",
+        "uidNumber": 10000 + number,
+        "gidNumber": 10000 + number,
+        "givenName": "Test",
+        "fullName": "Test User {0}".format(number),
+        "sn": "User",
+        "employeeType": "FAC",
+        "DNumber": "D{0:08d}".format(number),
+        "primO": "Physics",
+        "businessCategory": "staff",
+        "userPassword": "initial password"
+    }
+
+def pairs(rows):
+    """The (index, row) pairs of rows"""
+
+    return list(enumerate(rows))
+
+class OpenLDAPTest(unittest.TestCase):
+    """Runs against a fresh FakeDirectory with the bench settings"""
+
+    def setUp(self):
+        # The script reads its settings through readConfig()
+        openldap_settings.LDAPREPLICAS = []
+        openldap_settings.IDCOUNTER = ''
+        openldap_settings.SMTPSERVER = ''
+        for name, value in openldap_bench.SETTINGS.items():
+            setattr(openldap_settings, name, value)
+        openldap.readConfig('openldap_settings.py')
+
+        self.workdir = tempfile.mkdtemp(prefix='openldap_test')
+        self.directory = openldap_bench.FakeDirectory()
+        self.initialize = ldap.initialize
+        ldap.initialize = self.directory.connect
+
+    def tearDown(self):
+        ldap.initialize = self.initialize
+        shutil.rmtree(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def dn(self, name):
+        return "uid=" + name + openldap_bench.SETTINGS['EMPOU']
+
+    def run_main(self, rows, *args):
+        """Run openldap.main() on rows, return the rows of the output"""
+
+        in_file = self.path('input.json')
+        out_file = self.path('output.csv')
+        with open(in_file, 'wb') as f_in:
+            json.dump({"useractions": rows}, f_in)
+
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            sys.argv = ['openldap.py', '-f', in_file, '-o', out_file,
+                        '-q'] + list(args)
+            openldap.main(sys.argv)
+        finally:
+            os.chdir(cwd)
+
+        with open(out_file, 'rb') as f_out:
+            return [line[:3] for line in csv.reader(f_out)][1:]
+
+    def outcomes(self, results):
+        return [result.split(':')[0] for action, name, result in results]
+
+class PreflightTest(OpenLDAPTest):
+    """Rows --preflight rejects are reported and the run goes on"""
+
+    def test_rejected_rows_without_fields(self):
+        self.directory.preload('emp1')
+
+        results = self.run_main([
+            {"action": "delete"},
+            {"username": "emp2"},
+            {"action": "delete", "username": "emp1"}
+        ], '--preflight')
+
+        self.assertEqual(results, [
+            ['delete', '', "ERROR: Missing an expected input value for " \
+                            "username in input file"],
+            ['', 'emp2', "ERROR: Unrecognized action"],
+            ['delete', 'emp1', "SUCCESS: User deleted from ldap"]
+        ])
+        self.assertNotIn(self.dn('emp1').lower(), self.directory.entries)
+
+class ReadActionsTest(unittest.TestCase):
+    """Input files are read one entry at a time"""
+
+    def read(self, text, chunksize=1):
+        return list(openldap.readActions(StringIO.StringIO(text), chunksize))
+
+    def test_document(self):
+        rows = [user('create', 'emp1', 1), user('delete', 'emp2', 2)]
+        text = json.dumps({"useractions": rows})
+
+        self.assertEqual(self.read(text), rows)
+
+    def test_keys_before_useractions(self):
+        text = '{"generated": "2016-01-01", "count": 12345, ' \
+                '"meta": {"useractions": 1}, "useractions": [{"a": 1.5}]}'
+
+        self.assertEqual(self.read(text), [{"a": 1.5}])
+
+    def test_newline_delimited(self):
+        text = '{"action": "delete", "username": "emp1"}\n' \
+                '{"action": "delete", "username": "emp2"}\n'
+
+        self.assertEqual([row["username"] for row in self.read(text)],
+                            ['emp1', 'emp2'])
+
+    def test_useractions_not_a_list(self):
+        with self.assertRaises(TypeError):
+            self.read('{"useractions": {"action": "delete"}}', 4096)
+
+    def test_entries_across_reads(self):
+        rows = [user('create', 'emp{0}'.format(number), number)
+                for number in range(100)]
+        text = json.dumps({"useractions": rows}, indent=1)
+
+        self.assertGreater(len(text), 4096 * 4)
+        self.assertEqual(self.read(text, 4096), rows)
+
+class CoalesceTest(OpenLDAPTest):
+    """Actions on one account are planned as their net effect"""
+
+    def test_create_then_updates(self):
+        created = user('create', 'emp1', 1)
+        created["userPassword"] = "first password"
+        renamed = user('update', 'emp1', 2, 'emp9')
+
+        net = openldap.netAction(pairs([created, renamed]))
+
+        self.assertEqual(net["action"], 'create')
+        self.assertEqual(net["username"], 'emp9')
+        self.assertEqual(net["fullName"], "Test User 2")
+        self.assertEqual(net["userPassword"], "first password")
+
+    def test_create_then_delete(self):
+        net = openldap.netAction(pairs([user('create', 'emp1', 1),
+                                        user('delete', 'emp1', 2)]))
+
+        self.assertIs(net, openldap.NOCHANGE)
+
+    def test_updates_then_delete(self):
+        net = openldap.netAction(pairs([user('update', 'emp1', 1, 'emp2'),
+                                        user('delete', 'emp2', 2)]))
+
+        self.assertEqual(net, {"action": "delete", "username": "emp1"})
+
+    def test_chained_renames(self):
+        net = openldap.netAction(pairs([user('update', 'emp1', 1, 'emp2'),
+                                        user('update', 'emp2', 2, 'emp3')]))
+
+        self.assertEqual((net["action"], net["username"],
+                            net["newusername"]), ('update', 'emp1', 'emp3'))
+
+    def test_rows_that_run_alone(self):
+        incomplete = user('update', 'emp1', 2)
+        del incomplete["sn"]
+        self.assertIsNone(openldap.netAction(pairs([
+                            user('create', 'emp1', 1), incomplete])))
+
+        # A rename to a student changes the OU
+        self.assertIsNone(openldap.netAction(pairs([
+                            user('create', 'emp1', 1),
+                            user('update', 'emp1', 2, 'stu1_01')])))
+
+    def test_plan(self):
+        plans = openldap.coalesceRows(pairs([
+            user('create', 'emp1', 0),
+            user('update', 'emp2', 1),
+            user('update', 'emp1', 2, 'emp3'),
+            user('delete', 'emp3', 3),
+            user('update', 'emp2', 4)
+        ]))
+
+        self.assertEqual(sorted((indexes, row.get("action"))
+                                    for row, indexes in plans),
+                            [([0, 2, 3], None), ([1, 4], 'update')])
+
+    def test_coalesced_run(self):
+        self.directory.preload('emp2')
+
+        results = self.run_main([
+            user('create', 'emp1', 0),
+            user('update', 'emp1', 1, 'emp3'),
+            user('delete', 'emp2', 2),
+            user('create', 'emp2', 3)
+        ], '--coalesce')
+
+        self.assertEqual(self.outcomes(results), ['SUCCESS'] * 4)
+        self.assertIn(self.dn('emp3').lower(), self.directory.entries)
+        self.assertNotIn(self.dn('emp1').lower(), self.directory.entries)
+        self.assertEqual(self.directory.entries[self.dn('emp2').lower()]
+                            [1]['cn'], ["Test User 3"])
+
+class ScheduleTest(OpenLDAPTest):
+    """Rows are grouped by OU and keep their order per account"""
+
+    def test_grouped_by_ou(self):
+        rows = pairs([
+            user('delete', 'emp2', 0),
+            user('delete', 'stu1_01', 1),
+            user('delete', 'emp1', 2),
+            user('delete', 'gst0001', 3),
+            user('delete', 'stu2_01', 4)
+        ])
+
+        order = [index for index, row in openldap.scheduleRows(rows)]
+
+        self.assertEqual(sorted(order), range(5))
+        self.assertEqual([openldap.rowTarget(rows[index][1])[0]
+                            for index in order],
+                            sorted(openldap.rowTarget(row)[0]
+                                    for index, row in rows))
+        self.assertLess(order.index(2), order.index(0))
+
+    def test_chains_keep_order(self):
+        rows = pairs([
+            user('update', 'emp9', 0, 'emp5'),
+            user('update', 'emp5', 1, 'emp1'),
+            user('delete', 'emp1', 2),
+            user('delete', 'emp3', 3)
+        ])
+
+        order = [index for index, row in openldap.scheduleRows(rows)]
+
+        self.assertEqual([index for index in order if index < 3], [0, 1, 2])
+
+class ReconcileTest(OpenLDAPTest):
+    """A snapshot is turned into the actions that make it so"""
+
+    def test_external_sort(self):
+        present = openldap.ExternalSort(runsize=2)
+        for key, item in [('b', 1), ('a', 2), ('c', 3), ('a', 4), ('b', 5)]:
+            present.add(key, item)
+
+        self.assertEqual(len(present.files), 2)
+        self.assertEqual(list(present),
+                            [('a', 2), ('a', 4), ('b', 1), ('b', 5),
+                            ('c', 3)])
+
+    def test_merge_join(self):
+        joined = list(openldap.mergeJoin([('a', 1), ('b', 2), ('b', 3)],
+                                            [('b', 4), ('c', 5)]))
+
+        self.assertEqual(joined, [('a', [1], []), ('b', [2, 3], [4]),
+                                    ('c', [], [5])])
+
+    def entry(self, row, posix=False):
+        """The (dn, entry) of the user row describes"""
+
+        fields = [str(row[field]) for field in openldap.UPDATEFIELDS[1:]]
+        attrs = openldap.managedAttrs(*fields + [posix])
+        attrs['objectClass'] = ['top', 'person', 'organizationalPerson',
+                                'inetOrgPerson']
+        return self.dn(row["newusername"]), attrs
+
+    def test_reconcile(self):
+        same = user('create', 'emp1', 1)
+        changed = user('create', 'emp2', 2)
+        moved = user('create', 'emp3', 3)
+        gone = user('create', 'emp4', 4)
+        new = user('create', 'emp5', 5)
+
+        old = dict(changed, fullName="Old Name")
+        renamed = dict(moved, username='emp0', newusername='emp0')
+        present = openldap.sortEntries([self.entry(same), self.entry(old),
+                                        self.entry(renamed),
+                                        self.entry(gone)], runsize=2)
+
+        actions = sorted((row["action"], row["username"],
+                            row.get("newusername")) for row in
+                            openldap.reconcileRows([same, changed, moved,
+                                                    new], present, 2))
+
+        self.assertEqual(actions, [
+            ('create', 'emp5', 'emp5'),
+            ('delete', 'emp4', None),
+            ('update', 'emp0', 'emp3'),
+            ('update', 'emp2', 'emp2')
+        ])
+
+class JournalTest(OpenLDAPTest):
+    """Rows recorded in the journal are not run again"""
+
+    def journal(self):
+        with open(self.path('journal.txt'), 'rb') as f_journal:
+            return [line.rstrip('\n').split('\t')
+                    for line in f_journal]
+
+    def test_skip(self):
+        journal = openldap.Journal(self.path('journal.txt'))
+        row = user('update', 'emp1', 1)
+        digest = journal.digest(row)
+        journal.record(0, row, digest, "SUCCESS: User updated")
+        journal.close()
+
+        journal = openldap.Journal(self.path('journal.txt'))
+        self.assertEqual(journal.skip(0, row, digest, resume=True),
+                            "SKIPPED: Row already done in an earlier run")
+        self.assertEqual(journal.skip(5, row, digest),
+                            "SKIPPED: Row already applied in an earlier run")
+        self.assertIsNone(journal.skip(6, dict(row, sn="Other"),
+                            journal.digest(dict(row, sn="Other"))))
+        journal.close()
+
+    def test_resume(self):
+        self.directory.preload('emp1')
+        rows = [user('delete', 'emp1', 0), user('create', 'emp2', 1)]
+
+        results = self.run_main(rows, '-j', 'journal.txt')
+        self.assertEqual(self.outcomes(results), ['SUCCESS', 'SUCCESS'])
+
+        results = self.run_main(rows + [user('delete', 'emp2', 2)],
+                                '-j', 'journal.txt', '--resume')
+        self.assertEqual([result for action, name, result in results], [
+            "SKIPPED: Row already done in an earlier run",
+            "SKIPPED: Row already done in an earlier run",
+            "SUCCESS: User deleted from ldap"
+        ])
+        self.assertNotIn(self.dn('emp2').lower(), self.directory.entries)
+
+    def test_preflight_indexes(self):
+        self.directory.preload('emp1')
+        self.directory.preload('emp2')
+
+        self.run_main([
+            {"action": "delete"},
+            {"action": "delete", "username": "emp1"},
+            {"action": "delete", "username": "emp2"}
+        ], '--preflight', '-j', 'journal.txt')
+
+        self.assertEqual([(fields[0], fields[1], fields[4])
+                            for fields in self.journal()], [
+            ('0', '', 'ERROR'), ('1', 'emp1', 'SUCCESS'),
+            ('2', 'emp2', 'SUCCESS')
+        ])
+
+class TransactionTest(OpenLDAPTest):
+    """Writes are grouped in transactions where the server has them"""
+
+    def test_transactions(self):
+        self.directory.preload('emp1')
+
+        results = self.run_main([user('create', 'emp2', 0),
+                                    user('update', 'emp1', 1, 'emp3'),
+                                    user('delete', 'emp3', 2)], '-t', '10')
+
+        self.assertEqual(self.outcomes(results), ['SUCCESS'] * 3)
+        self.assertEqual(sorted(self.directory.entries),
+                            [self.dn('emp2').lower()])
+
+    def test_failed_commit_replays(self):
+        fail = self.dn('emp2').lower()
+        add = openldap_bench.FakeLDAPObject.add
+
+        def refuse(obj, dn, modlist):
+            if dn.lower() == fail:
+                raise ldap.UNWILLING_TO_PERFORM({'desc': 'Unwilling'})
+            return add(obj, dn, modlist)
+
+        openldap_bench.FakeLDAPObject.add = refuse
+        try:
+            results = self.run_main([user('create', 'emp1', 0),
+                                        user('create', 'emp2', 1),
+                                        user('create', 'emp3', 2),
+                                        user('delete', 'emp2', 3)],
+                                    '-t', '3', '--prefetch')
+        finally:
+            openldap_bench.FakeLDAPObject.add = add
+
+        self.assertEqual(self.outcomes(results),
+                            ['SUCCESS', 'ERROR', 'SUCCESS', 'ERROR'])
+        self.assertIn("could not be found", results[3][2])
+        self.assertEqual(sorted(self.directory.entries),
+                            [self.dn('emp1').lower(), self.dn('emp3').lower()])
+
+    def test_fallback(self):
+        extop_s = openldap_bench.FakeLDAPObject.extop_s
+
+        def unsupported(obj, *args, **kwargs):
+            raise ldap.PROTOCOL_ERROR({'desc': 'Protocol error'})
+
+        for patch in [unsupported, None]:
+            self.directory = openldap_bench.FakeDirectory()
+            ldap.initialize = self.directory.connect
+            if patch:
+                openldap_bench.FakeLDAPObject.extop_s = patch
+            else:
+                # A server library without extended operations
+                del openldap_bench.FakeLDAPObject.extop_s
+            try:
+                results = self.run_main([user('create', 'emp1', 0),
+                                            user('create', 'emp2', 1)],
+                                        '-t', '10')
+            finally:
+                openldap_bench.FakeLDAPObject.extop_s = extop_s
+
+            self.assertEqual(self.outcomes(results), ['SUCCESS'] * 2)
+            self.assertEqual(len(self.directory.entries), 2)
+
+class PipelineTest(OpenLDAPTest):
+    """Asynchronous writes report and index what the server did"""
+
+    def test_failed_add_not_indexed(self):
+        fail = self.dn('emp1').lower()
+        add = openldap_bench.FakeLDAPObject.add
+
+        def refuse(obj, dn, modlist):
+            if dn.lower() == fail:
+                raise ldap.UNWILLING_TO_PERFORM({'desc': 'Unwilling'})
+            return add(obj, dn, modlist)
+
+        openldap_bench.FakeLDAPObject.add = refuse
+        try:
+            results = self.run_main([user('create', 'emp1', 0),
+                                        user('create', 'emp2', 1),
+                                        user('delete', 'emp1', 2)],
+                                    '-p', '4', '--prefetch')
+        finally:
+            openldap_bench.FakeLDAPObject.add = add
+
+        self.assertEqual(self.outcomes(results),
+                            ['ERROR', 'SUCCESS', 'ERROR'])
+        self.assertIn("could not be found", results[2][2])
+
+    def test_runs_again(self):
+        # Settings of a run must not leak into the next one
+        results = self.run_main([user('create', 'emp1', 0)], '--prefetch')
+        self.assertEqual(self.outcomes(results), ['SUCCESS'])
+
+        self.directory = openldap_bench.FakeDirectory()
+        ldap.initialize = self.directory.connect
+        results = self.run_main([user('delete', 'emp1', 0)])
+        self.assertEqual(self.outcomes(results), ['ERROR'])
+
+class OptionsTest(OpenLDAPTest):
+    """Options that do not go together are refused before any work"""
+
+    def test_notify_with_dry_run(self):
+        openldap_settings.SMTPSERVER = 'localhost'
+        self.directory.preload('emp1')
+
+        with self.assertRaises(SystemExit):
+            self.run_main([user('delete', 'emp1', 0)], '--dry-run',
+                            '--notify')
+
+        self.assertFalse(os.path.exists(self.path('output.csv')))
+        self.assertIn(self.dn('emp1').lower(), self.directory.entries)
+
+if __name__ == "__main__":
+    unittest.main()